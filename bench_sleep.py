@@ -0,0 +1,216 @@
+"""
+Benchmark of SleepDataProcessor on synthetic Hexoskin exports.
+
+Generates 1 Hz summary exports and 256 Hz raw exports of several night lengths,
+times every pipeline stage and its peak memory, and compares the timings with
+stored baselines. Runs offline.
+
+    python bench_sleep.py --save-baseline        # record the baselines of this machine
+    python bench_sleep.py --threshold 1.5        # fail if a stage is 50% slower
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from optparse import OptionParser
+
+import numpy as np
+import pandas as pd
+
+from hexo_decisionTree import SleepDataProcessor
+from hexo_loader import (ACCELERATION_FREQ, ACCELERATION_X, ACCELERATION_Y, ACCELERATION_Z, CACHE_DIR, ECG,
+                         ECG_FREQ, RESPIRATION_ABDOMINAL, RESPIRATION_FREQ, RESPIRATION_THORACIC, TIME_COLUMN)
+
+SUMMARY_COLUMNS = {
+    'heart_rate [bpm](/api/datatype/19/)': (60., 8., 2.),
+    'breathing_rate [rpm](/api/datatype/33/)': (14., 2., 1.),
+    'minute_ventilation [mL/min](/api/datatype/36/)': (6000., 800., 300.),
+    'tidal_volume [mL](/api/datatype/37/)': (450., 60., 30.),
+    'activity [g](/api/datatype/49/)': (0.01, 0., 0.005),
+    'cadence [spm](/api/datatype/53/)': (0., 0., 0.),
+    'heart_rate_variability [ms](/api/datatype/1000/)': (50., 10., 5.),
+}
+RAW_COLUMNS = {
+    ECG: 'ECG_I [na](/api/datatype/%d/)' % ECG,
+    RESPIRATION_THORACIC: 'respiration_thoracic [na](/api/datatype/%d/)' % RESPIRATION_THORACIC,
+    RESPIRATION_ABDOMINAL: 'respiration_abdominal [na](/api/datatype/%d/)' % RESPIRATION_ABDOMINAL,
+    ACCELERATION_X: 'acceleration_X [g](/api/datatype/%d/)' % ACCELERATION_X,
+    ACCELERATION_Y: 'acceleration_Y [g](/api/datatype/%d/)' % ACCELERATION_Y,
+    ACCELERATION_Z: 'acceleration_Z [g](/api/datatype/%d/)' % ACCELERATION_Z,
+}
+START = 1718900000  # s
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baselines.json')
+
+
+def generate_summary(path, hours, seed=0):
+    """1 Hz Hexoskin summary export with slow sleep-like oscillations, noise and gaps."""
+    rng = np.random.default_rng(seed)
+    n = int(hours * 3600)
+    t = np.arange(n)
+    data = {TIME_COLUMN: (START + t) * 256}
+    for column, (mean, amplitude, noise) in SUMMARY_COLUMNS.items():
+        values = mean + amplitude * np.sin(2 * np.pi * t / 5400.) + rng.normal(0, noise, n)
+        values[rng.random(n) < 0.02] = np.nan
+        data[column] = values
+    activity = 'activity [g](/api/datatype/49/)'
+    data[activity] = np.abs(data[activity])
+    data[activity][:900] += 0.2  # awake at the start and end of the night
+    data[activity][-900:] += 0.2
+    pd.DataFrame(data).to_csv(path, index=False, float_format='%.4f')
+
+
+def generate_raw(path, hours, seed=0, chunk_seconds=600):
+    """256 Hz Hexoskin raw export (ECG, respiration, accelerometer), written in chunks."""
+    rng = np.random.default_rng(seed)
+    beat_phase = breath_phase = 0.
+    header = True
+    for start in range(0, int(hours * 3600), chunk_seconds):
+        t = start * ECG_FREQ + np.arange(chunk_seconds * ECG_FREQ)
+        seconds = t / ECG_FREQ
+        hr = 60 + 8 * np.sin(2 * np.pi * seconds / 5400.)
+        beats = beat_phase + np.cumsum(hr / 60. / ECG_FREQ)
+        ecg = rng.normal(0, 20, len(t)) + 300 * np.sin(2 * np.pi * 0.2 * seconds)
+        ecg[np.flatnonzero(np.diff(np.floor(beats), prepend=np.floor(beat_phase)) > 0)] += 1000
+        beat_phase = beats[-1]
+        br = 14 + 2 * np.sin(2 * np.pi * seconds / 5400.)
+        breaths = breath_phase + np.cumsum(br / 60. / ECG_FREQ)
+        breath_phase = breaths[-1]
+        respiration = 1000 * np.sin(2 * np.pi * breaths) + rng.normal(0, 50, len(t))
+
+        data = {TIME_COLUMN: START * 256 + t, RAW_COLUMNS[ECG]: ecg}
+        for datatype in (RESPIRATION_THORACIC, RESPIRATION_ABDOMINAL):
+            values = respiration.copy()
+            values[t % (ECG_FREQ // RESPIRATION_FREQ) != 0] = np.nan
+            data[RAW_COLUMNS[datatype]] = values
+        for datatype, gravity in ((ACCELERATION_X, 0.), (ACCELERATION_Y, 0.), (ACCELERATION_Z, 1.)):
+            values = gravity + rng.normal(0, 0.02, len(t))
+            values[t % (ECG_FREQ // ACCELERATION_FREQ) != 0] = np.nan
+            data[RAW_COLUMNS[datatype]] = values
+        pd.DataFrame(data).to_csv(path, index=False, header=header, mode='w' if header else 'a',
+                                  float_format='%.4f')
+        header = False
+
+
+def measure(fn, memory=False):
+    """
+    Runs fn, returns its wall time in s, or with memory=True the peak of traced memory
+    in MB. tracemalloc slows every allocation down, so both are never measured at once.
+    """
+    if not memory:
+        start = time.perf_counter()
+        fn()
+        return time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark_file(path, raw_signals=False, memory=False):
+    """Measures every stage of SleepDataProcessor on one file, from a cold cache."""
+    shutil.rmtree(os.path.join(os.path.dirname(path), CACHE_DIR), ignore_errors=True)
+    processor = SleepDataProcessor(path, raw_signals=raw_signals)
+    stages = {}
+    for name, params in processor.STAGES:
+        stages[name] = measure(lambda: processor.run_stage(name), memory)
+
+    def classify():
+        processor.classification = processor.classify_sleep_stages(processor.thresholds)
+
+    def correct():
+        processor.classify_sleep_stages(processor.corrected_thresholds)
+        processor.apply_corrections()
+
+    stages['classify_sleep_stages'] = measure(classify, memory)
+    stages['apply_corrections'] = measure(correct, memory)
+    return stages
+
+
+def run(hours, raw_hours, data_dir, repeat):
+    """
+    Returns {case: {stage: {'time': s, 'memory': MB}}}, keeping the best time of repeat
+    runs. The memory is measured in one more run.
+    """
+    cases = [('summary', h) for h in hours] + [('raw', h) for h in raw_hours]
+    results = {}
+    for kind, h in cases:
+        case = '%s_%gh' % (kind, h)
+        path = os.path.join(data_dir, case, '%s.csv' % case)
+        if not os.path.isfile(path):
+            print('Generating %s...' % path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            (generate_raw if kind == 'raw' else generate_summary)(path, h)
+        times = {}
+        for _ in range(repeat):
+            for stage, elapsed in benchmark_file(path, raw_signals=kind == 'raw').items():
+                times[stage] = min(elapsed, times.get(stage, elapsed))
+        peaks = benchmark_file(path, raw_signals=kind == 'raw', memory=True)
+        results[case] = {stage: {'time': times[stage], 'memory': peaks[stage]} for stage in times}
+    return results
+
+
+def compare(results, baselines, threshold, min_time=0.05):
+    """Lists the stages slower than threshold times their baseline."""
+    regressions = []
+    for case, stages in results.items():
+        for stage, result in stages.items():
+            baseline = baselines.get(case, {}).get(stage)
+            if baseline is None:
+                continue
+            # Stages faster than min_time are dominated by timer noise
+            if result['time'] > max(baseline['time'], min_time) * threshold:
+                regressions.append((case, stage, baseline['time'], result['time']))
+    return regressions
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--hours", dest="hours", type='string', default='8,24,72',
+                      help="night lengths in hours of the 1 Hz summary exports.")
+    parser.add_option("--raw-hours", dest="raw_hours", type='string', default='8',
+                      help="night lengths in hours of the 256 Hz raw exports, empty for none.")
+    parser.add_option("--data-dir", dest="data_dir", type='string',
+                      default=os.path.join(tempfile.gettempdir(), 'hexo_bench'),
+                      help="where the synthetic exports are generated and kept between runs.")
+    parser.add_option("--baseline", dest="baseline", type='string', default=BASELINE_FILE,
+                      help="baseline file.")
+    parser.add_option("--save-baseline", dest="save_baseline", action="store_true", default=False,
+                      help="store the results as the new baselines.")
+    parser.add_option("--threshold", dest="threshold", type='float', default=1.5,
+                      help="fail if a stage takes more than threshold times its baseline.")
+    parser.add_option("--repeat", dest="repeat", type='int', default=3,
+                      help="number of runs per file, the fastest is kept.")
+    (options, args) = parser.parse_args()
+
+    parse = lambda s: [float(h) for h in s.split(',') if h]
+    results = run(parse(options.hours), parse(options.raw_hours), options.data_dir, options.repeat)
+
+    for case, stages in results.items():
+        print(case)
+        for stage, result in stages.items():
+            print('  %-24s %9.3f s %9.1f MB' % (stage, result['time'], result['memory']))
+
+    if options.save_baseline:
+        with open(options.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Baselines saved to %s' % options.baseline)
+        return 0
+
+    if not os.path.isfile(options.baseline):
+        print('No baselines found at %s, run with --save-baseline first.' % options.baseline)
+        return 1
+    with open(options.baseline) as f:
+        baselines = json.load(f)
+    regressions = compare(results, baselines, options.threshold)
+    for case, stage, baseline, current in regressions:
+        print('REGRESSION %s %s: %.3f s -> %.3f s' % (case, stage, baseline, current))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
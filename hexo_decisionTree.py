@@ -1,136 +1,430 @@
+import hashlib
+import json
 import os
-import pandas as pd
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import numpy as np
-from scipy.signal import find_peaks
+
+from hexo_loader import ACTIVITY, BREATHING_RATE, CACHE_DIR, HEART_RATE, TIME_COLUMN, file_hash, load_export
+from hexo_raw_features import derive_features
+
+
+def windowed_variability(x, q=20):
+    """
+    Mean absolute successive difference |x[j+1] - x[j]| over the window
+    j in [i-q, i+q] around every epoch i, computed from a cumulative sum in O(n).
+    The window is truncated at the edges and always averages the differences it
+    actually contains.
+    """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    if n < 2:
+        return np.zeros(n)
+    csum = np.concatenate(([0.], np.cumsum(np.abs(np.diff(x)))))
+    i = np.arange(n)
+    hi = np.clip(i + q + 1, 0, n - 1)
+    # The last epoch has no difference after it, its window always keeps the one before it
+    lo = np.minimum(np.clip(i - q, 0, n - 1), hi - 1)
+    return (csum[hi] - csum[lo]) / (hi - lo)
+
+
+def windowed_mean(x, q=20):
+    """Mean of x over the window [i-q, i+q] around every epoch i, truncated at the edges."""
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    csum = np.concatenate(([0.], np.cumsum(x)))
+    i = np.arange(n)
+    lo = np.clip(i - q, 0, n)
+    hi = np.clip(i + q + 1, 0, n)
+    return (csum[hi] - csum[lo]) / (hi - lo)
+
+
+def artifact_mask(x, threshold=3, window=None):
+    """
+    Boolean mask of the artifacts of x, without modifying it.
+    With window=None, values further than threshold standard deviations from the
+    global mean are artifacts. Otherwise a rolling robust z-score is used: the
+    distance to the median of the surrounding window epochs, in units of their
+    median absolute deviation. NaN values are never flagged.
+    """
+    x = np.asarray(x, dtype=float)
+    with np.errstate(invalid='ignore'):
+        if window is None:
+            return np.abs(x - np.nanmean(x)) > threshold * np.nanstd(x)
+        half = window // 2
+        padded = np.pad(x, half, mode='edge')
+        windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * half + 1)
+        median = np.nanmedian(windows, axis=1)
+        mad = np.nanmedian(np.abs(windows - median[:, None]), axis=1)
+        z = 0.6745 * np.abs(x - median) / np.where(mad > 0, mad, np.inf)
+        return z > threshold
+
+
+def forward_fill(x, mask=None):
+    """
+    Copy of x where NaN values, and values where mask is True, are replaced by
+    the last valid value before them. Leading invalid values take the first
+    valid value.
+    """
+    x = np.asarray(x, dtype=float)
+    invalid = np.isnan(x)
+    if mask is not None:
+        invalid |= mask
+    if not invalid.any() or invalid.all():
+        return x.copy()
+    idx = np.where(invalid, 0, np.arange(len(x)))
+    idx[:np.argmax(~invalid)] = np.argmax(~invalid)
+    np.maximum.accumulate(idx, out=idx)
+    return x[idx]
+
+
+def classify(hrv, brv, body_movement, thresholds, means=None):
+    """
+    REM, Wake and NREM masks of the epochs. The features are compared to the
+    whole-night means unless means=(mean_hrv, mean_brv, mean_body_movement) is given.
+    """
+    k1, k2, k3 = thresholds
+    if means is None:
+        means = np.mean(hrv), np.mean(brv), np.mean(body_movement)
+    mean_hrv, mean_brv, mean_body_movement = means
+
+    rem_sleep = (hrv > k1 * mean_hrv) & (brv > k2 * mean_brv) & (body_movement < k3 * mean_body_movement)
+    wake = body_movement > k3 * mean_body_movement
+    nrem_sleep = ~rem_sleep & ~wake
+
+    return rem_sleep, wake, nrem_sleep
+
+
+def stages_from_masks(rem_sleep, wake, nrem_sleep, dtype=float):
+    classification = np.zeros(len(rem_sleep), dtype=dtype)
+    classification[rem_sleep] = 2  # REM sleep
+    classification[wake] = 0  # Wake
+    classification[nrem_sleep] = 1  # NREM sleep
+    return classification
+
+
+def apply_sleep_corrections(rem_sleep, wake, nrem_sleep):
+    """
+    Sleep onset/offset corrections, in place. Nights without any NREM epoch after the
+    first 4 minutes (e.g. too short) are corrected to Wake, as in sweep_thresholds.
+    """
+    wake[:4*3] = True  # First 4 minutes as Wake
+    onsets = np.where(nrem_sleep[4*3:] == True)[0]
+    sleep_onset = onsets[0] + 4*3 if len(onsets) else len(wake)  # First occurrence of NREM after 4 minutes
+    wake[:sleep_onset] = True
+
+    # Sleep offset correction
+    sleep = np.where((nrem_sleep == True) | (rem_sleep == True))[0]
+    if len(sleep):
+        wake[sleep[-1]+1:] = True
+
+    return rem_sleep, wake, nrem_sleep
+
+
+def sweep_thresholds(hrv, brv, body_movement, thresholds_grid, reference=None, corrections=False,
+                     batch_size=1024):
+    """
+    Classifies the epochs for many (k1, k2, k3) threshold triples at once by
+    broadcasting the triples against the features.
+
+    :param thresholds_grid: array of shape (n_triples, 3)
+    :param reference: optional reference stages (0 Wake, 1 NREM, 2 REM) of every epoch,
+        e.g. PSG scoring, to score each triple against
+    :param corrections: apply the sleep onset/offset corrections of apply_sleep_corrections.
+        Triples without any NREM epoch after the first 4 minutes are corrected to Wake.
+    :param batch_size: number of triples classified at once, bounds the memory used
+    :return: dict with 'classification' (n_triples, n_epochs) int8 and, with a reference,
+        'accuracy' and 'kappa' (n_triples,)
+    """
+    grid = np.atleast_2d(np.asarray(thresholds_grid, dtype=float))
+    hrv, brv, body_movement = (np.asarray(x, dtype=float)[None, :] for x in (hrv, brv, body_movement))
+    n_epochs = hrv.shape[1]
+    mean_hrv, mean_brv, mean_body_movement = np.mean(hrv), np.mean(brv), np.mean(body_movement)
+    epoch = np.arange(n_epochs)[None, :]
+
+    classification = np.empty((len(grid), n_epochs), dtype=np.int8)
+    if reference is not None:
+        expected = (np.asarray(reference).astype(int)[:, None] == np.arange(3)).astype(float)
+        confusion = np.empty((len(grid), 3, 3))
+    for start in range(0, len(grid), batch_size):
+        k1, k2, k3 = (k[:, None] for k in grid[start:start + batch_size].T)
+        rem_sleep = (hrv > k1 * mean_hrv) & (brv > k2 * mean_brv) & (body_movement < k3 * mean_body_movement)
+        wake = body_movement > k3 * mean_body_movement
+        nrem_sleep = ~rem_sleep & ~wake
+
+        if corrections:
+            wake[:, :4*3] = True
+            # Padded so nights of 4 minutes or less still have an (empty) onset search range
+            after_start = np.pad(nrem_sleep[:, 4*3:], ((0, 0), (0, 1)))
+            has_onset = after_start.any(axis=1)
+            sleep_onset = np.where(has_onset, np.argmax(after_start, axis=1) + 4*3, n_epochs)
+            sleep = nrem_sleep | rem_sleep
+            sleep_offset_start = n_epochs - 1 - np.argmax(sleep[:, ::-1], axis=1)
+            wake |= (epoch < sleep_onset[:, None]) | (epoch > sleep_offset_start[:, None])
+
+        # Same precedence as stages_from_masks: NREM over Wake over REM
+        stages = np.where(nrem_sleep, 1, np.where(wake, 0, np.where(rem_sleep, 2, 0)))
+        classification[start:start + batch_size] = stages
+        if reference is not None:
+            # Confusion matrices of the batch, (n_triples, predicted, expected)
+            predicted = (stages[:, :, None] == np.arange(3)).astype(float)
+            confusion[start:start + batch_size] = np.einsum('tni,nj->tij', predicted, expected)
+
+    result = {'classification': classification}
+    if reference is not None:
+        observed = np.trace(confusion, axis1=1, axis2=2) / n_epochs
+        chance = np.einsum('ti,ti->t', confusion.sum(axis=2), confusion.sum(axis=1)) / n_epochs ** 2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            kappa = np.where(chance < 1, (observed - chance) / (1 - chance), 1.)
+        result['accuracy'] = observed
+        result['kappa'] = kappa
+    return result
+
 
 class SleepDataProcessor:
-    def __init__(self, file_path, epoch_length=20, thresholds=None, corrected_thresholds=None):
+    __slots__ = (
+        'file_path', 'memo_dir', 'raw_signals', 'compact', '_stage_keys', 'epoch_length', 'variability_window',
+        'artifact_threshold', 'artifact_window', 'thresholds', 'corrected_thresholds', 'data', 'rr_intervals',
+        'rr_times', 'rmssd_epochs', 'time_seconds', 'hr', 'br', 'activity', 'raw_epochs', 'hr_epochs', 'br_epochs',
+        'activity_epochs', 'artifact_masks', 'hrv', 'brv', 'body_movement', 'rem_sleep', 'wake', 'nrem_sleep',
+        'classification', 'classification_corrected',
+    )
+    # Pipeline stages in order, with the parameters each one depends on. A stage is
+    # rerun only when its parameters or those of an upstream stage changed.
+    STAGES = (
+        ('load_data', ('raw_signals',)),
+        ('preprocess_signals', ()),
+        ('segment_into_epochs', ('epoch_length', 'compact')),
+        ('handle_artifacts', ('artifact_threshold', 'artifact_window')),
+        ('compute_variability', ('variability_window',)),
+    )
+    # Outputs of the last stage, saved by the on-disk memo
+    FEATURES = ('hr_epochs', 'br_epochs', 'activity_epochs', 'hrv', 'brv', 'body_movement')
+
+    def __init__(self, file_path, epoch_length=20, thresholds=None, corrected_thresholds=None,
+                 variability_window=20, artifact_threshold=3, artifact_window=None, memo_dir=None,
+                 raw_signals=False, compact=False):
+        """
+        :param raw_signals: derive heart rate, breathing rate and activity from the raw ECG,
+            respiration and accelerometer instead of the precomputed 1 Hz columns. HRV is then
+            the RMSSD of the R-R intervals of every epoch, averaged over variability_window.
+        :param memo_dir: optional directory where the features of every file and parameter
+            set are saved, so that a new processor reclassifying the same night skips
+            loading and feature extraction
+        :param compact: keep memory bounded on long recordings: the loaded frame and signals
+            are dropped once epoched (rerunning segment_into_epochs reloads them), epoch
+            features are stored as float32 and stages as int8
+        """
         self.file_path = file_path
+        self.memo_dir = memo_dir
+        self.raw_signals = raw_signals
+        self.compact = compact
+        self._stage_keys = {}
         self.epoch_length = epoch_length
+        self.variability_window = variability_window
+        self.artifact_threshold = artifact_threshold
+        self.artifact_window = artifact_window
         self.thresholds = thresholds if thresholds is not None else [0.5, 1.1, 0.6]
         self.corrected_thresholds = corrected_thresholds if corrected_thresholds is not None else [0.5, 1.2, 0.6]
         self.data = None
+        self.rr_intervals = None
+        self.rr_times = None
+        self.rmssd_epochs = None
         self.time_seconds = None
+        self.hr = None
+        self.br = None
+        self.activity = None
+        self.raw_epochs = None
         self.hr_epochs = None
         self.br_epochs = None
         self.activity_epochs = None
+        self.artifact_masks = None
+        self.hrv = None
+        self.brv = None
+        self.body_movement = None
+        self.rem_sleep = None
+        self.wake = None
+        self.nrem_sleep = None
         self.classification = None
         self.classification_corrected = None
 
+    def parameters(self):
+        """Parameters that change the results, used as part of the result cache key."""
+        return {
+            'epoch_length': self.epoch_length,
+            'thresholds': list(self.thresholds),
+            'corrected_thresholds': list(self.corrected_thresholds),
+            'variability_window': self.variability_window,
+            'artifact_threshold': self.artifact_threshold,
+            'artifact_window': self.artifact_window,
+            'raw_signals': self.raw_signals,
+            'compact': self.compact,
+        }
+
+    @property
+    def feature_dtype(self):
+        return np.float32 if self.compact else float
+
+    @property
+    def stage_dtype(self):
+        return np.int8 if self.compact else float
+
+    def _stage_key(self, stage):
+        """Parameters of a stage and of all the stages upstream of it."""
+        key = [self.file_path, os.path.getmtime(self.file_path)]
+        for name, params in self.STAGES:
+            key.extend(getattr(self, p) for p in params)
+            if name == stage:
+                return tuple(key)
+        raise ValueError('Unknown stage %s' % stage)
+
+    def run_stage(self, stage):
+        """Runs a stage, and the stages upstream of it, unless their parameters did not change."""
+        key = self._stage_key(stage)
+        if self._stage_keys.get(stage) == key:
+            return
+        if stage == self.STAGES[-1][0] and self._load_memo(key):
+            self._stage_keys[stage] = key
+            return
+        index = [name for name, params in self.STAGES].index(stage)
+        if index > 0:
+            self.run_stage(self.STAGES[index - 1][0])
+        getattr(self, stage)()
+        self._stage_keys[stage] = key
+        if stage == self.STAGES[-1][0]:
+            self._save_memo(key)
+
+    def clear_memo(self):
+        """Forgets the in-memory stage results, the next run starts from load_data."""
+        self._stage_keys = {}
+
+    def _memo_path(self, key):
+        params = json.dumps([str(k) for k in key[2:]])
+        digest = hashlib.sha1(('%s:%s' % (file_hash(self.file_path), params)).encode('utf8')).hexdigest()
+        return os.path.join(self.memo_dir, '%s.npz' % digest)
+
+    def _load_memo(self, key):
+        if self.memo_dir is None:
+            return False
+        try:
+            with np.load(self._memo_path(key)) as f:
+                for name in self.FEATURES:
+                    setattr(self, name, f[name])
+        except (IOError, ValueError, KeyError):
+            return False
+        return True
+
+    def _save_memo(self, key):
+        if self.memo_dir is None:
+            return
+        try:
+            os.makedirs(self.memo_dir, exist_ok=True)
+            path = self._memo_path(key)
+            np.savez(path + '.tmp.npz', **{name: getattr(self, name) for name in self.FEATURES})
+            os.replace(path + '.tmp.npz', path)
+        except IOError as e:
+            print("Couldn't write to memo: %s" % e)
+
     def load_data(self):
-        self.data = pd.read_csv(self.file_path)
-        self.time_seconds = self.data['time [s/256]'] / 256
+        if self.raw_signals:
+            self.data, self.rr_intervals = derive_features(self.file_path)
+            # Every heart rate row is one R-R interval, at the time of its closing beat
+            beats = self.data[HEART_RATE].notna().to_numpy()
+            self.rr_times = self.data[TIME_COLUMN].to_numpy()[beats] / 256
+        else:
+            self.data = load_export(self.file_path, [HEART_RATE, BREATHING_RATE, ACTIVITY])
+        self.time_seconds = self.data[TIME_COLUMN] / 256
 
     def preprocess_signals(self):
         def preprocess_signal(signal):
             return signal.dropna()
 
-        self.hr = preprocess_signal(self.data['heart_rate [bpm](/api/datatype/19/)'])
-        self.br = preprocess_signal(self.data['breathing_rate [rpm](/api/datatype/33/)'])
-        self.activity = preprocess_signal(self.data['activity [g](/api/datatype/49/)'])
+        self.hr = preprocess_signal(self.data[HEART_RATE])
+        self.br = preprocess_signal(self.data[BREATHING_RATE])
+        self.activity = preprocess_signal(self.data[ACTIVITY])
 
     def segment_into_epochs(self):
-        def segment_signal(time, signal, epoch_length):
-            start_time = time.iloc[0]
-            epochs = []
-            current_epoch = []
-            for t, d in zip(time, signal):
-                if t - start_time < epoch_length:
-                    current_epoch.append(d)
-                else:
-                    epochs.append(current_epoch)
-                    start_time = t
-                    current_epoch = [d]
-            if current_epoch:
-                epochs.append(current_epoch)
-            return np.array([np.mean(epoch) for epoch in epochs if len(epoch) > 0])
-
-        self.hr_epochs = segment_signal(self.time_seconds, self.hr, self.epoch_length)
-        self.br_epochs = segment_signal(self.time_seconds, self.br, self.epoch_length)
-        self.activity_epochs = segment_signal(self.time_seconds, self.activity, self.epoch_length)
+        # Epoch of every row, computed once for all signals by binning time
+        time = self.time_seconds.to_numpy(dtype=float)
+        epoch_index = np.floor((time - time[0]) / self.epoch_length).astype(np.int64)
+        n_epochs = int(epoch_index.max()) + 1
 
-    def handle_artifacts(self):
-        def detect_artifacts(signal, threshold=3):
-            artifacts = np.abs(signal - np.nanmean(signal)) > threshold * np.nanstd(signal)
-            signal[artifacts] = np.nan
-            return signal
-
-        def fill_nan_with_last_valid(signal):
-            valid_idx = np.where(~np.isnan(signal))[0]
-            if valid_idx.size == 0:
-                return signal
-            last_valid = valid_idx[0]
-            for i in range(len(signal)):
-                if np.isnan(signal[i]):
-                    signal[i] = signal[last_valid]
-                else:
-                    last_valid = i
-            return signal
-
-        self.hr_epochs = fill_nan_with_last_valid(detect_artifacts(self.hr_epochs))
-        self.br_epochs = fill_nan_with_last_valid(detect_artifacts(self.br_epochs))
-        self.activity_epochs = fill_nan_with_last_valid(detect_artifacts(self.activity_epochs))
+        def segment_signal(signal):
+            # Signals were dropna()'d, so align them on the row index, not on position
+            idx = epoch_index[self.data.index.get_indexer(signal.index)]
+            values = signal.to_numpy(dtype=float)
+            valid = ~np.isnan(values)
+            counts = np.bincount(idx[valid], minlength=n_epochs)
+            sums = np.bincount(idx[valid], weights=values[valid], minlength=n_epochs)
+            # Epochs without any sample are NaN and filled by handle_artifacts
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return (sums / counts).astype(self.feature_dtype, copy=False)
 
-    def compute_variability(self):
-        def compute_hrv(hr, q=20):
-            return np.array([np.mean(np.abs(hr[max(0, i-q):i+q+1] - hr[max(0, i+1-q):i+q+2])) for i in range(len(hr))])
+        self.hr_epochs = segment_signal(self.hr)
+        self.br_epochs = segment_signal(self.br)
+        self.activity_epochs = segment_signal(self.activity)
+        # Kept so handle_artifacts can be rerun without resegmenting
+        self.raw_epochs = {'hr': self.hr_epochs, 'br': self.br_epochs, 'activity': self.activity_epochs}
+        self.rmssd_epochs = None
+        if self.rr_intervals is not None and len(self.rr_intervals) > 1:
+            # RMSSD in ms, each successive R-R difference counting in the epoch of its last beat
+            idx = np.floor((self.rr_times[1:] - time[0]) / self.epoch_length).astype(np.int64)
+            idx = np.clip(idx, 0, n_epochs - 1)
+            squares = np.bincount(idx, weights=(1000 * np.diff(self.rr_intervals)) ** 2, minlength=n_epochs)
+            counts = np.bincount(idx, minlength=n_epochs)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                self.rmssd_epochs = np.sqrt(squares / counts).astype(self.feature_dtype, copy=False)
+            self.raw_epochs['rmssd'] = self.rmssd_epochs
+        if self.compact:
+            self.data = self.time_seconds = self.hr = self.br = self.activity = None
+            # Upstream stages have to run again before the next segmentation
+            self._stage_keys.pop('load_data', None)
+            self._stage_keys.pop('preprocess_signals', None)
 
-        def compute_brv(br, q=20):
-            return np.array([np.mean(np.abs(br[max(0, i-q):i+q+1] - br[max(0, i+1-q):i+q+2])) for i in range(len(br))])
+    def handle_artifacts(self):
+        self.artifact_masks = {}
+        for name in self.raw_epochs:
+            epochs = self.raw_epochs[name]
+            mask = artifact_mask(epochs, self.artifact_threshold, self.artifact_window)
+            self.artifact_masks[name] = mask
+            setattr(self, '%s_epochs' % name, forward_fill(epochs, mask).astype(self.feature_dtype, copy=False))
 
+    def compute_variability(self):
         def compute_body_movement(activity, p=0.01):
             return np.log2(p + activity)
 
-        self.hrv = compute_hrv(self.hr_epochs)
-        self.brv = compute_brv(self.br_epochs)
-        self.body_movement = compute_body_movement(self.activity_epochs)
+        dtype = self.feature_dtype
+        if self.rmssd_epochs is not None:
+            # Beat-to-beat HRV from the ECG
+            self.hrv = windowed_mean(self.rmssd_epochs, self.variability_window).astype(dtype, copy=False)
+        else:
+            self.hrv = windowed_variability(self.hr_epochs, self.variability_window).astype(dtype, copy=False)
+        self.brv = windowed_variability(self.br_epochs, self.variability_window).astype(dtype, copy=False)
+        self.body_movement = compute_body_movement(self.activity_epochs).astype(dtype, copy=False)
 
     def classify_sleep_stages(self, thresholds):
-        def classify(hrv, brv, body_movement, thresholds):
-            k1, k2, k3 = thresholds
-            mean_hrv = np.mean(hrv)
-            mean_brv = np.mean(brv)
-            mean_body_movement = np.mean(body_movement)
-            
-            rem_sleep = (hrv > k1 * mean_hrv) & (brv > k2 * mean_brv) & (body_movement < k3 * mean_body_movement)
-            wake = body_movement > k3 * mean_body_movement
-            nrem_sleep = ~rem_sleep & ~wake
-            
-            return rem_sleep, wake, nrem_sleep
-
         rem_sleep, wake, nrem_sleep = classify(self.hrv, self.brv, self.body_movement, thresholds)
-        
-        classification = np.zeros(len(self.hrv))
-        classification[rem_sleep] = 2  # REM sleep
-        classification[wake] = 0  # Wake
-        classification[nrem_sleep] = 1  # NREM sleep
-        
-        return classification
+        # Kept for apply_corrections
+        self.rem_sleep, self.wake, self.nrem_sleep = rem_sleep, wake, nrem_sleep
+        return stages_from_masks(rem_sleep, wake, nrem_sleep, self.stage_dtype)
 
     def apply_corrections(self):
-        def apply_sleep_corrections(rem_sleep, wake, nrem_sleep):
-            wake[:4*3] = True  # First 4 minutes as Wake
-            sleep_onset = np.where(nrem_sleep[4*3:] == True)[0][0] + 4*3  # First occurrence of NREM after 4 minutes
-            wake[:sleep_onset] = True
-            
-            # Sleep offset correction
-            sleep_offset_start = np.where((nrem_sleep == True) | (rem_sleep == True))[0][-1]
-            wake[sleep_offset_start+1:] = True
-            
-            return rem_sleep, wake, nrem_sleep
-
         rem_sleep_corrected, wake_corrected, nrem_sleep_corrected = apply_sleep_corrections(self.rem_sleep.copy(), self.wake.copy(), self.nrem_sleep.copy())
-        self.classification_corrected = np.zeros(len(self.hrv))
-        self.classification_corrected[rem_sleep_corrected] = 2  # REM sleep
-        self.classification_corrected[wake_corrected] = 0  # Wake
-        self.classification_corrected[nrem_sleep_corrected] = 1  # NREM sleep
+        self.classification_corrected = stages_from_masks(rem_sleep_corrected, wake_corrected, nrem_sleep_corrected,
+                                                          self.stage_dtype)
+
+    def sweep_thresholds(self, thresholds_grid, reference=None, corrections=False):
+        """Classifies the night for every (k1, k2, k3) triple of thresholds_grid at once, see sweep_thresholds."""
+        self.run_stage('compute_variability')
+        return sweep_thresholds(self.hrv, self.brv, self.body_movement, thresholds_grid,
+                                reference=reference, corrections=corrections)
 
     def process(self):
-        self.load_data()
-        self.preprocess_signals()
-        self.segment_into_epochs()
-        self.handle_artifacts()
-        self.compute_variability()
+        # Only the stages whose parameters changed since the last call are rerun
+        self.run_stage('compute_variability')
 
         # Classification without corrections
         self.classification = self.classify_sleep_stages(self.thresholds)
@@ -153,30 +447,319 @@ class SleepDataProcessor:
 
         return result_without_corrections, result_with_corrections
 
+
+class OnlineSleepStager:
+    """
+    Incremental sleep staging of epochs as they arrive, e.g. from the DataPoller of
+    test_hexo.py. Every epoch costs O(1): running means replace the whole-night means
+    and HRV/BRV use a trailing window of the last 2*q successive differences.
+    finalize() revises the whole night with the batch features and the sleep
+    onset/offset corrections once the recording is over.
+    """
+
+    DATATYPES = (HEART_RATE, BREATHING_RATE, ACTIVITY)
+
+    def __init__(self, epoch_length=20, thresholds=None, corrected_thresholds=None,
+                 variability_window=20, artifact_threshold=3, freq=256):
+        self.epoch_length = epoch_length
+        self.thresholds = thresholds if thresholds is not None else [0.5, 1.1, 0.6]
+        self.corrected_thresholds = corrected_thresholds if corrected_thresholds is not None else [0.5, 1.2, 0.6]
+        self.variability_window = variability_window
+        self.artifact_threshold = artifact_threshold
+        self.freq = freq
+
+        self.epochs = []  # raw (hr, br, activity) epoch means
+        self.stages = []  # provisional stages
+        # Welford mean/M2 and count of the raw signals, for artifact detection
+        self._count = np.zeros(3)
+        self._mean = np.zeros(3)
+        self._m2 = np.zeros(3)
+        self._last_valid = np.full(3, np.nan)
+        # Trailing successive differences of hr and br, and their sums
+        self._diffs = deque(maxlen=2 * variability_window)
+        self._diff_sum = np.zeros(2)
+        # Sums of hrv, brv and body movement for the running means
+        self._feature_sum = np.zeros(3)
+        # Partial epochs fed through add_data: epoch index -> [sums, counts]
+        self._t0 = None
+        self._pending = {}
+        self._next_epoch = 0
+
+    def add_epoch(self, hr, br, activity):
+        """Adds the mean hr, br and activity of the next epoch and returns its provisional stage."""
+        raw = np.array([hr, br, activity], dtype=float)
+        self.epochs.append(raw)
+
+        # Artifacts and missing values take the last valid value
+        valid = ~np.isnan(raw)
+        std = np.sqrt(self._m2 / np.maximum(self._count - 1, 1))
+        with np.errstate(invalid='ignore'):
+            artifact = valid & (self._count > 1) & (np.abs(raw - self._mean) > self.artifact_threshold * std)
+        self._count += valid
+        delta = np.where(valid, raw - self._mean, 0.)
+        self._mean += delta / np.maximum(self._count, 1)
+        self._m2 += delta * np.where(valid, raw - self._mean, 0.)
+        clean = np.where(valid & ~artifact, raw, self._last_valid)
+        clean = np.where(np.isnan(clean), raw, clean)
+        previous = self._last_valid
+        self._last_valid = np.where(np.isnan(clean), self._last_valid, clean)
+
+        # Trailing variability of hr and br
+        if not np.isnan(previous[:2]).any() and not np.isnan(clean[:2]).any():
+            if len(self._diffs) == self._diffs.maxlen:
+                self._diff_sum -= self._diffs[0]
+            diff = np.abs(clean[:2] - previous[:2])
+            self._diffs.append(diff)
+            self._diff_sum += diff
+        hrv, brv = self._diff_sum / len(self._diffs) if self._diffs else (0., 0.)
+        body_movement = np.log2(0.01 + clean[2])
+
+        features = np.array([hrv, brv, body_movement])
+        self._feature_sum += np.nan_to_num(features)
+        means = self._feature_sum / len(self.epochs)
+        rem_sleep, wake, nrem_sleep = classify(*features[:, None], self.thresholds, means=means)
+        stage = int(stages_from_masks(rem_sleep, wake, nrem_sleep)[0])
+        self.stages.append(stage)
+        return stage
+
+    def add_data(self, data):
+        """
+        Adds samples as returned by DataPoller.poll(): {datatype: [(timestamp, value), ...]}
+        with timestamps in 1/freq s. Epochs before the latest one seen are closed and
+        staged, the stages of the closed epochs are returned. Empty epochs are staged
+        from the last valid values.
+        """
+        if self._t0 is None:
+            timestamps = [values[0][0] for datatype, values in data.items()
+                          if datatype in self.DATATYPES and values]
+            if not timestamps:
+                return []
+            self._t0 = min(timestamps) / self.freq
+        for signal, datatype in enumerate(self.DATATYPES):
+            for timestamp, value in data.get(datatype, []):
+                t = timestamp / self.freq
+                epoch = int((t - self._t0) // self.epoch_length)
+                if epoch < self._next_epoch or value is None:
+                    continue  # too late, that epoch is already staged
+                sums, counts = self._pending.setdefault(epoch, [np.zeros(3), np.zeros(3)])
+                sums[signal] += value
+                counts[signal] += 1
+
+        if not self._pending:
+            return []
+        return self._close_epochs(max(self._pending))
+
+    def _close_epochs(self, stop):
+        """Stages the pending epochs before stop."""
+        stages = []
+        while self._next_epoch < stop:
+            sums, counts = self._pending.pop(self._next_epoch, [np.zeros(3), np.zeros(3)])
+            with np.errstate(invalid='ignore', divide='ignore'):
+                stages.append(self.add_epoch(*(sums / counts)))
+            self._next_epoch += 1
+        return stages
+
+    def finalize(self):
+        """
+        Stages the whole night again with the batch features and whole-night means,
+        and applies the sleep onset/offset corrections.
+        Returns (classification, classification_corrected).
+        """
+        if self._pending:
+            self._close_epochs(max(self._pending) + 1)
+        epochs = np.array(self.epochs, dtype=float).reshape(-1, 3).T
+        filled = [forward_fill(x, artifact_mask(x, self.artifact_threshold)) for x in epochs]
+        hrv = windowed_variability(filled[0], self.variability_window)
+        brv = windowed_variability(filled[1], self.variability_window)
+        body_movement = np.log2(0.01 + filled[2])
+
+        classification = stages_from_masks(*classify(hrv, brv, body_movement, self.thresholds))
+        masks = classify(hrv, brv, body_movement, self.corrected_thresholds)
+        classification_corrected = stages_from_masks(*apply_sleep_corrections(*masks))
+        return classification, classification_corrected
+
+
+def process_file(file_path, **processor_kwargs):
+    """Process one file in a worker process and time it."""
+    start = time.perf_counter()
+    processor = SleepDataProcessor(file_path, **processor_kwargs)
+    result_without_corrections, result_with_corrections = processor.process()
+    return result_without_corrections, result_with_corrections, time.perf_counter() - start
+
+
+class ResultStore:
+    """
+    Persistent per-file results, one compressed .npz per file keyed by the hash
+    of the file content and the processor parameters.
+    """
+
+    RESULT_KEYS = ('hr_mean', 'br_mean', 'activity_mean')
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def key(self, file_path, parameters):
+        params = json.dumps(parameters, sort_keys=True)
+        return hashlib.sha1(('%s:%s' % (file_hash(file_path), params)).encode('utf8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '%s.npz' % key)
+
+    def get(self, key):
+        return self.load(self._path(key))
+
+    def set(self, key, result_without_corrections, result_with_corrections):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.save(self._path(key), result_without_corrections, result_with_corrections)
+        except IOError as e:
+            print("Couldn't write to result cache: %s" % e)
+
+    @classmethod
+    def load(cls, path):
+        """Reads the results saved by save, None if the file is missing or unreadable."""
+        try:
+            with np.load(path) as f:
+                result_without_corrections = {k: f[k] for k in cls.RESULT_KEYS}
+                result_with_corrections = dict(result_without_corrections)
+                result_without_corrections['classification'] = f['classification']
+                result_with_corrections['classification'] = f['classification_corrected']
+        except (IOError, ValueError, KeyError):
+            return None
+        return result_without_corrections, result_with_corrections
+
+    @classmethod
+    def save(cls, path, result_without_corrections, result_with_corrections):
+        # Write then rename so an interrupted run never leaves a truncated entry
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(tmp_path,
+                            classification=result_without_corrections['classification'],
+                            classification_corrected=result_with_corrections['classification'],
+                            **{k: result_with_corrections[k] for k in cls.RESULT_KEYS})
+        os.replace(tmp_path, path)
+
+
 class FolderProcessor:
-    def __init__(self, folder_path):
+    def __init__(self, folder_path, n_jobs=1, use_cache=True, cache_dir=None, results_dir=None,
+                 **processor_kwargs):
+        """
+        :param folder_path: folder containing the Hexoskin CSV exports
+        :param n_jobs: number of worker processes, None for one per CPU. 1 processes serially.
+        :param use_cache: skip files whose results are already in the result cache
+        :param cache_dir: result cache directory, defaults to .hexo_cache/results in folder_path
+        :param results_dir: if given, process_all_files writes the results of every file to
+            <results_dir>/<name>.npz as it finishes instead of keeping them in memory, and
+            get_results reads them back one at a time
+        :param processor_kwargs: forwarded to every SleepDataProcessor, e.g. compact=True
+        """
         self.folder_path = folder_path
+        self.n_jobs = n_jobs
+        self.processor_kwargs = processor_kwargs
+        self.store = None
+        if use_cache:
+            self.store = ResultStore(cache_dir or os.path.join(folder_path, CACHE_DIR, 'results'))
+        self.results_dir = results_dir
         self.results = []
+        self.result_files = {}
+        self.errors = {}
+        self.timings = {}
+        self.cached = []
 
-    def process_all_files(self):
-        for file_name in os.listdir(self.folder_path):
-            if file_name.endswith('.csv'):
+    def list_files(self):
+        return sorted(f for f in os.listdir(self.folder_path) if f.endswith('.csv'))
+
+    def iter_results(self):
+        """
+        Yields (file_name, result_without_corrections, result_with_corrections) as
+        files finish. A failing file does not stop the others: its exception is
+        stored in self.errors and it is skipped. Processing times are stored in
+        self.timings. Files found in the result cache are yielded first without
+        being processed, and listed in self.cached.
+        """
+        keys = {}
+        file_names = []
+        for file_name in self.list_files():
+            if self.store is not None:
                 file_path = os.path.join(self.folder_path, file_name)
-                processor = SleepDataProcessor(file_path)
-                result_without_corrections, result_with_corrections = processor.process()
+                parameters = SleepDataProcessor(file_path, **self.processor_kwargs).parameters()
+                keys[file_name] = self.store.key(file_path, parameters)
+                cached = self.store.get(keys[file_name])
+                if cached:
+                    self.cached.append(file_name)
+                    yield (file_name,) + cached
+                    continue
+            file_names.append(file_name)
+
+        if self.n_jobs == 1:
+            for file_name in file_names:
+                result = self._collect(file_name, keys.get(file_name), lambda: process_file(
+                    os.path.join(self.folder_path, file_name), **self.processor_kwargs))
+                if result:
+                    yield result
+            return
+
+        with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+            futures = {executor.submit(process_file, os.path.join(self.folder_path, file_name),
+                                       **self.processor_kwargs): file_name
+                       for file_name in file_names}
+            for future in as_completed(futures):
+                file_name = futures[future]
+                result = self._collect(file_name, keys.get(file_name), future.result)
+                if result:
+                    yield result
+
+    def _collect(self, file_name, key, get_result):
+        try:
+            result_without_corrections, result_with_corrections, elapsed = get_result()
+        except Exception as e:
+            self.errors[file_name] = e
+            print(f"Failed to process {file_name}: {e!r}")
+            return None
+        self.timings[file_name] = elapsed
+        print(f"Processed {file_name} in {elapsed:.2f} s")
+        if key is not None:
+            self.store.set(key, result_without_corrections, result_with_corrections)
+        return file_name, result_without_corrections, result_with_corrections
+
+    def process_all_files(self):
+        if self.results_dir is not None:
+            os.makedirs(self.results_dir, exist_ok=True)
+        for file_name, result_without_corrections, result_with_corrections in self.iter_results():
+            if self.results_dir is None:
                 self.results.append((file_name, result_without_corrections, result_with_corrections))
+                continue
+            path = os.path.join(self.results_dir, os.path.splitext(file_name)[0] + '.npz')
+            ResultStore.save(path, result_without_corrections, result_with_corrections)
+            self.result_files[file_name] = path
+
+    def iter_saved_results(self):
+        """
+        Yields the results written to results_dir, loading one file at a time. Saved
+        results that went missing or cannot be read are skipped and stored in self.errors.
+        """
+        for file_name, path in self.result_files.items():
+            result = ResultStore.load(path)
+            if result is None:
+                self.errors[file_name] = IOError("Couldn't read the saved results %s" % path)
+                print(f"Failed to load the results of {file_name} from {path}")
+                continue
+            yield (file_name,) + result
 
     def get_results(self):
+        if self.results_dir is not None:
+            return self.iter_saved_results()
         return self.results
 
-# Example usage
-folder_path = '/mnt/data/your_folder_name'
-folder_processor = FolderProcessor(folder_path)
-folder_processor.process_all_files()
-results = folder_processor.get_results()
-
-for file_name, result_without_corrections, result_with_corrections in results:
-    print(f"Results for {file_name} without corrections:")
-    print(result_without_corrections)
-    print(f"Results for {file_name} with corrections:")
-    print(result_with_corrections)
+
+if __name__ == '__main__':
+    # Example usage
+    folder_path = sys.argv[1] if len(sys.argv) > 1 else '/mnt/data/your_folder_name'
+    folder_processor = FolderProcessor(folder_path, n_jobs=None)
+    folder_processor.process_all_files()
+    results = folder_processor.get_results()
+
+    for file_name, result_without_corrections, result_with_corrections in results:
+        print(f"Results for {file_name} without corrections:")
+        print(result_without_corrections)
+        print(f"Results for {file_name} with corrections:")
+        print(result_with_corrections)
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+TIME_COLUMN = 'time [s/256]'
+
+# Hexoskin datatype ids
+HEART_RATE = 19
+BREATHING_RATE = 33
+ACTIVITY = 49
+# Raw signals, with their sampling rates in Hz
+ECG = 4113
+RESPIRATION_THORACIC = 4129
+RESPIRATION_ABDOMINAL = 4130
+ACCELERATION_X = 4145
+ACCELERATION_Y = 4146
+ACCELERATION_Z = 4147
+ECG_FREQ = 256
+RESPIRATION_FREQ = 128
+ACCELERATION_FREQ = 64
+
+CACHE_DIR = '.hexo_cache'
+
+_DATATYPE_RE = re.compile(r'/api/datatype/(\d+)/')
+
+
+def datatype_columns(file_path):
+    """
+    Maps the datatype ids of a Hexoskin CSV export to its column names, e.g.
+    {19: 'heart_rate [bpm](/api/datatype/19/)'}. Only the header is read.
+    """
+    header = pd.read_csv(file_path, nrows=0).columns
+    columns = {}
+    for column in header:
+        match = _DATATYPE_RE.search(column)
+        if match:
+            columns[int(match.group(1))] = column
+    return columns
+
+
+# Hashes already computed in this process: path -> ((size, mtime), sha1)
+_hashes = {}
+
+
+def file_hash(file_path, chunk_size=1 << 20):
+    """
+    SHA1 of the content of a file. Hashes are remembered by (path, size, mtime), in
+    memory and in .hexo_cache/hashes.json next to the file, so a file is read in full
+    only once as long as it does not change.
+    """
+    file_path = os.path.abspath(file_path)
+    stat = os.stat(file_path)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    known = _hashes.get(file_path)
+    if known is not None and known[0] == stamp:
+        return known[1]
+
+    index_path = os.path.join(os.path.dirname(file_path), CACHE_DIR, 'hashes.json')
+    name = os.path.basename(file_path)
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        index = {}
+    entry = index.get(name)
+    if isinstance(entry, dict) and entry.get('stamp') == stamp:
+        digest = entry['sha1']
+    else:
+        sha1 = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha1.update(chunk)
+        digest = sha1.hexdigest()
+        index[name] = {'stamp': stamp, 'sha1': digest}
+        try:
+            os.makedirs(os.path.dirname(index_path), exist_ok=True)
+            # Write then rename, concurrent writers at worst forget each other's entries
+            tmp_path = '%s.%s.tmp' % (index_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, index_path)
+        except IOError:
+            pass
+    _hashes[file_path] = (stamp, digest)
+    return digest
+
+
+def load_export(file_path, datatypes=None, use_cache=True, cache_dir=None):
+    """
+    Loads the time column and the requested datatypes of a Hexoskin CSV export.
+    Only the requested columns are parsed, as float32 (time stays float64).
+    Parsed columns are cached as .npy files keyed by the hash of the file, so
+    later loads of any subset of them skip the CSV parsing altogether.
+
+    :param file_path: Hexoskin CSV export
+    :param datatypes: datatype ids to load, None for all of them
+    :param use_cache: read and write the binary cache
+    :param cache_dir: cache directory, defaults to .hexo_cache next to the file
+    :return: DataFrame with TIME_COLUMN and one column per datatype id
+    """
+    columns = datatype_columns(file_path)
+    if datatypes is None:
+        datatypes = list(columns)
+    missing = [d for d in datatypes if d not in columns]
+    if missing:
+        raise KeyError('Datatypes %s not found in %s' % (missing, file_path))
+
+    cache_path = None
+    arrays = {}
+    if use_cache:
+        cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(file_path)), CACHE_DIR)
+        cache_path = os.path.join(cache_dir, file_hash(file_path))
+        for key in ['time'] + list(datatypes):
+            try:
+                arrays[key] = np.load(os.path.join(cache_path, '%s.npy' % key))
+            except (IOError, ValueError):
+                pass
+
+    to_parse = [d for d in datatypes if d not in arrays]
+    if to_parse or 'time' not in arrays:
+        usecols = [TIME_COLUMN] + [columns[d] for d in to_parse]
+        dtype = {columns[d]: np.float32 for d in to_parse}
+        dtype[TIME_COLUMN] = np.float64
+        parsed = pd.read_csv(file_path, usecols=usecols, dtype=dtype)
+        arrays['time'] = parsed[TIME_COLUMN].to_numpy()
+        for d in to_parse:
+            arrays[d] = parsed[columns[d]].to_numpy()
+        if cache_path is not None:
+            try:
+                os.makedirs(cache_path, exist_ok=True)
+                np.save(os.path.join(cache_path, 'time.npy'), arrays['time'])
+                for d in to_parse:
+                    np.save(os.path.join(cache_path, '%s.npy' % d), arrays[d])
+            except IOError as e:
+                print("Couldn't write to cache: %s" % e)
+
+    data = pd.DataFrame({TIME_COLUMN: arrays['time']})
+    for d in datatypes:
+        data[d] = arrays[d]
+    return data
@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+from scipy.signal import butter, find_peaks, sosfilt, sosfilt_zi
+
+from hexo_loader import (ACCELERATION_FREQ, ACCELERATION_X, ACCELERATION_Y, ACCELERATION_Z, ACTIVITY,
+                         BREATHING_RATE, ECG, ECG_FREQ, HEART_RATE, RESPIRATION_FREQ, RESPIRATION_THORACIC,
+                         TIME_COLUMN, datatype_columns)
+
+
+class ChunkedPeakDetector:
+    """
+    Peak detection on a uniformly sampled signal fed chunk by chunk. The band-pass
+    state is carried between chunks, and the last samples of each chunk are kept
+    so peaks across chunk boundaries are found exactly once.
+    """
+
+    def __init__(self, fs, band, min_interval, height_ratio=0.4, percentile=99.):
+        """
+        :param fs: sampling rate in Hz
+        :param band: (low, high) band-pass corners in Hz
+        :param min_interval: minimum time between two peaks, in s
+        :param height_ratio: peaks must reach height_ratio times the percentile of the chunk
+        :param percentile: percentile of the filtered chunk used as reference height
+        """
+        self.sos = butter(2, band, btype='bandpass', fs=fs, output='sos')
+        self.min_interval = min_interval
+        self.distance = max(1, int(min_interval * fs))
+        self.height_ratio = height_ratio
+        self.percentile = percentile
+        self._zi = None
+        self._values = np.zeros(0)
+        self._times = np.zeros(0)
+        self._last_peak_time = -np.inf
+
+    def push(self, values, times, final=False):
+        """Adds a chunk of samples and returns the times of the confirmed peaks."""
+        values = np.asarray(values, dtype=float)
+        if len(values):
+            if self._zi is None:
+                self._zi = sosfilt_zi(self.sos) * values[0]
+            filtered, self._zi = sosfilt(self.sos, values, zi=self._zi)
+            self._values = np.concatenate((self._values, filtered))
+            self._times = np.concatenate((self._times, times))
+        if not len(self._values) or (len(self._values) < 2 * self.distance and not final):
+            return np.zeros(0)
+
+        height = self.height_ratio * np.percentile(self._values, self.percentile)
+        peaks, _ = find_peaks(self._values, height=height, distance=self.distance)
+        # A peak close to the end may still lose against a higher one in the next chunk
+        end = len(self._values) if final else len(self._values) - self.distance
+        # Peaks already reported may have been trimmed, so their distance is enforced on time
+        peaks = peaks[(peaks < end) & (self._times[peaks] >= self._last_peak_time + self.min_interval)]
+        peak_times = self._times[peaks]
+        if len(peak_times):
+            self._last_peak_time = peak_times[-1]
+
+        keep = max(0, end - self.distance)
+        self._values = self._values[keep:]
+        self._times = self._times[keep:]
+        return peak_times
+
+
+def derive_features(file_path, chunk_seconds=600, freq=256):
+    """
+    Derives heart rate, breathing rate and activity from the raw ECG, thoracic
+    respiration and accelerometer of a Hexoskin CSV export, reading the file in chunks
+    so whole nights never have to fit in memory.
+
+    Heart rate is computed beat to beat from the R-R intervals, breathing rate breath
+    to breath, and activity as the per-second mean absolute deviation of the
+    acceleration magnitude from gravity, in g.
+
+    :param file_path: Hexoskin CSV export containing the raw signals
+    :param chunk_seconds: seconds of recording read at once
+    :param freq: time base of the time column, in ticks per second
+    :return: (data, rr_intervals) where data has TIME_COLUMN and the HEART_RATE,
+        BREATHING_RATE and ACTIVITY columns like hexo_loader.load_export, with NaN
+        where a signal has no value, and rr_intervals are the R-R intervals in s
+    """
+    columns = datatype_columns(file_path)
+    accelerations = [columns[d] for d in (ACCELERATION_X, ACCELERATION_Y, ACCELERATION_Z)]
+    usecols = [TIME_COLUMN, columns[ECG], columns[RESPIRATION_THORACIC]] + accelerations
+    dtype = {c: np.float32 for c in usecols}
+    dtype[TIME_COLUMN] = np.float64
+
+    ecg = ChunkedPeakDetector(ECG_FREQ, (5., 15.), min_interval=0.3)
+    respiration = ChunkedPeakDetector(RESPIRATION_FREQ, (0.1, 1.), min_interval=1.5, height_ratio=0.3,
+                                      percentile=90.)
+    gravity_sos = butter(2, 0.5, btype='lowpass', fs=ACCELERATION_FREQ, output='sos')
+    gravity_zi = None
+
+    beat_times, breath_times, activity_times, activity = [], [], [], []
+    reader = pd.read_csv(file_path, usecols=usecols, dtype=dtype, chunksize=int(chunk_seconds * ECG_FREQ))
+    for chunk in reader:
+        time = chunk[TIME_COLUMN].to_numpy() / freq
+
+        values = chunk[columns[ECG]].to_numpy()
+        valid = ~np.isnan(values)
+        beat_times.append(ecg.push(values[valid], time[valid]))
+
+        values = chunk[columns[RESPIRATION_THORACIC]].to_numpy()
+        valid = ~np.isnan(values)
+        breath_times.append(respiration.push(values[valid], time[valid]))
+
+        acc = chunk[accelerations].to_numpy(dtype=float)
+        valid = ~np.isnan(acc).any(axis=1)
+        if valid.any():
+            magnitude = np.sqrt(np.einsum('ij,ij->i', acc[valid], acc[valid]))
+            if gravity_zi is None:
+                gravity_zi = sosfilt_zi(gravity_sos) * magnitude[0]
+            gravity, gravity_zi = sosfilt(gravity_sos, magnitude, zi=gravity_zi)
+            # Mean absolute deviation per second of the chunk
+            seconds = np.floor(time[valid])
+            second, index = np.unique(seconds, return_inverse=True)
+            activity_times.append(second)
+            activity.append(np.bincount(index, weights=np.abs(magnitude - gravity)) / np.bincount(index))
+    beat_times.append(ecg.push([], [], final=True))
+    breath_times.append(respiration.push([], [], final=True))
+
+    beat_times = np.concatenate(beat_times)
+    breath_times = np.concatenate(breath_times)
+    rr_intervals = np.diff(beat_times)
+    breath_intervals = np.diff(breath_times)
+
+    # One row per value, at the time of the beat / breath / second it belongs to
+    parts = [
+        pd.DataFrame({TIME_COLUMN: beat_times[1:] * freq, HEART_RATE: 60. / rr_intervals}),
+        pd.DataFrame({TIME_COLUMN: breath_times[1:] * freq, BREATHING_RATE: 60. / breath_intervals}),
+        pd.DataFrame({TIME_COLUMN: np.concatenate(activity_times or [np.zeros(0)]) * freq,
+                      ACTIVITY: np.concatenate(activity or [np.zeros(0)])}),
+    ]
+    data = pd.concat(parts, ignore_index=True).sort_values(TIME_COLUMN, kind='stable', ignore_index=True)
+    data = data[[TIME_COLUMN, HEART_RATE, BREATHING_RATE, ACTIVITY]].astype(
+        {HEART_RATE: np.float32, BREATHING_RATE: np.float32, ACTIVITY: np.float32})
+    return data, rr_intervals
@@ -0,0 +1,361 @@
+"""asyncio variant of the Hexoskin api client, on top of aiohttp."""
+import asyncio
+import re
+import time
+from collections import deque
+from itertools import islice
+
+import aiohttp
+import requests
+import yarl
+from requests.structures import CaseInsensitiveDict
+
+from .client import ApiHelper, ApiResourceAccessor, ApiResourceInstance, ApiResourceList, ApiResponse, OAuth2Token
+from .errors import HttpForbidden, HttpNotFound
+
+
+class AsyncApiResourceAccessor(ApiResourceAccessor):
+    """
+    Accessor to the resource of the api whose list, get and create are coroutines.
+    The results are the same types as with ApiHelper, with AsyncApiResourceInstance
+    and AsyncApiResourceList for instances and lists.
+    """
+
+    async def list(self, get_args=None, format=None, auth=None, **kwargs):
+        self._verify_call('list', 'get')
+        get_args = get_args or {}
+        get_args.update(kwargs)
+        get_args = self.api.convert_instances(get_args)
+        response = await self.api.get(self._conf['list_endpoint'], get_args, auth=auth, **self._hdrs(format))
+        return await self._build_async_response(response)
+
+    async def get(self, uri, format=None, auth=None, force_refresh=False):
+        self._verify_call('detail', 'get')
+        if type(uri) is int or self._conf['list_endpoint'] not in uri:
+            uri = '%s%s/' % (self._conf['list_endpoint'], uri)
+        api_instance = self.api._object_cache.get(uri) if format != 'application/json' else None
+        if force_refresh or not api_instance or api_instance._lazy:
+            response = await self.api.get(uri, auth=auth, **self._hdrs(format))
+            api_instance = await self._build_async_response(response)
+        return api_instance
+
+    async def create(self, data, auth=None, *args, **kwargs):
+        self._verify_call('list', 'post')
+        data = self.api.convert_instances(data)
+        response = await self.api.post(self.endpoint, data, auth=auth, *args, **kwargs)
+        if response.result:
+            return self.api._object_cache.set(self._instance(response.result))
+        uri = response.headers['Location']
+        rsrc_type, id = self.api.resource_and_id_from_uri(uri)
+        return self.api._object_cache.set(self._instance({'resource_uri': uri, 'id': id}, lazy=True))
+
+    async def _build_async_response(self, response):
+        if response.content_type == 'application/json' and self._is_data_response(response)[0]:
+            # The rows of data results link to their records
+            await self.api.resource('record')
+        return self._build_response(response)
+
+    def _build_list(self, response):
+        return AsyncApiResourceList(response, self)
+
+    def _instance(self, obj, lazy=False):
+        return AsyncApiResourceInstance(obj, self, lazy=lazy)
+
+
+class AsyncApiResourceInstance(ApiResourceInstance):
+    """
+    ApiResourceInstance whose update, delete and load are coroutines. The fields of a
+    lazy instance are not fetched on attribute access, await instance.load() first.
+    """
+
+    def __getattr__(self, name):
+        if name not in self.fields and self._lazy and name in self._parent._conf['fields']:
+            raise AttributeError("'%s' of %s is not loaded yet, await instance.load() first"
+                                 % (name, self.fields.get('resource_uri')))
+        return super(AsyncApiResourceInstance, self).__getattr__(name)
+
+    async def load(self):
+        """Fetches the fields of a lazy instance, returns the instance."""
+        if self._lazy:
+            response = await self._parent.api.get(self.fields['resource_uri'])
+            self.update_fields(response.result)
+            self._lazy = False
+        return self
+
+    async def update(self, data=None, *args, **kwargs):
+        self._parent._verify_call('detail', 'put')
+        if data is not None:
+            for k, v in data.items():
+                setattr(self, k, v)
+        response = await self._parent.api.put(self.fields['resource_uri'],
+                                              self._parent.api.convert_instances(self.fields), *args, **kwargs)
+        if response.result:
+            self.update_fields(response.result.copy())
+        return response
+
+    async def delete(self, *args, **kwargs):
+        self._parent._verify_call('detail', 'delete')
+        response = await self._parent.api.delete(self.fields['resource_uri'], *args, **kwargs)
+        self.fields = {k: None for k in self.fields.keys()}
+        return response
+
+
+class AsyncApiResourceList(ApiResourceList):
+
+    def __delitem__(self, key):
+        raise TypeError('Deleting needs a request, use await item.delete() and list.remove(item)')
+
+    async def iter_all(self, depth=2):
+        """
+        Async generator of all the elements of a call. Up to depth pages are requested
+        ahead of the one being consumed, so at most depth pages are held in memory.
+        """
+        pages = self._iter_pages(depth)
+        try:
+            i = 0
+            while i < self.response.result['meta']['total_count']:
+                if len(self) == 0:
+                    try:
+                        response = await pages.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    self._append_response(response)
+                i += 1
+                yield self.popleft()
+        finally:
+            await pages.aclose()
+
+    async def prefetch_all(self, depth=None):
+        """Downloads all the remaining pages, depth at a time (defaults to the api concurrency)."""
+        async for response in self._iter_pages(depth):
+            self._append_response(response)
+        return self
+
+    async def load_next(self):
+        if not self.nexturl:
+            raise StopAsyncIteration('List is already at the end.')
+        self._append_response(await self._parent.api.get(self.nexturl))
+
+    async def load_prev(self):
+        if not self.prevurl:
+            raise StopAsyncIteration('List is already at the beginning.')
+        self._append_response(await self._parent.api.get(self.prevurl), prepend=True)
+
+    async def _iter_pages(self, depth=None):
+        urls = self._page_urls()
+        if urls is None:
+            while self.nexturl:
+                yield await self._parent.api.get(self.nexturl)
+            return
+        urls = iter(urls)
+        api = self._parent.api
+        pending = deque(asyncio.ensure_future(api.get(url)) for url in islice(urls, max(1, depth or api.concurrency)))
+        try:
+            while pending:
+                response = await pending.popleft()
+                pending.extend(asyncio.ensure_future(api.get(url)) for url in islice(urls, 1))
+                yield response
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+class AsyncApiHelper(ApiHelper):
+    """
+    ApiHelper whose requests are coroutines sharing one aiohttp connection pool,
+    with at most `concurrency` of them in flight. The auth classes and result types
+    are the ones of ApiHelper.
+
+    Resources are loaded with `await api.resource('range')`, or all at once with
+    `await api.warm_up()`; after that `api.range` works as with ApiHelper. Lazy
+    related instances are not fetched on attribute access, get them with
+    `await instance.load()` or `await api.resource_from_uri(uri)`.
+    """
+
+    def __init__(self, api_key=None, api_secret=None, api_version='', auth=None, base_url=None, verify_ssl=True,
+                 pool_size=10, concurrency=10):
+        """
+        :param pool_size: number of keep-alive connections kept open to the api
+        :param concurrency: maximum number of requests in flight
+        """
+        self.concurrency = concurrency
+        self._semaphore = None
+        super(AsyncApiHelper, self).__init__(api_key, api_secret, api_version, auth, base_url, verify_ssl, pool_size)
+
+    def _create_session(self, pool_size):
+        # The aiohttp session has to be created in the event loop, see _get_session
+        self.pool_size = pool_size
+        return None
+
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ssl=self.verify_ssl)
+            self.session = aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar())
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self.session
+
+    async def close(self):
+        """Closes the pooled connections."""
+        if self.session is not None:
+            await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in self.resources:
+            return self.resources[name]
+        if self._resource_list is None:
+            self._load_stash()
+        if name in self.resource_conf:
+            self.resources[name] = AsyncApiResourceAccessor(name, self.resource_conf[name], self)
+            return self.resources[name]
+        raise AttributeError("'%s' is not a loaded API endpoint, use await api.resource('%s')" % (name, name))
+
+    async def resource(self, name):
+        """Accessor of a resource, fetching its schema if needed."""
+        if name not in self.resource_conf:
+            await self._load_resource_list()
+            if name in self._resource_list:
+                await self._fetch_resource_conf(name)
+                self._save_stash()
+        return getattr(self, name)
+
+    async def build_resources(self, rate=3.):
+        await self.warm_up(rate=rate)
+
+    async def warm_up(self, names=None, rate=3.):
+        """
+        Fetches the schemas of many resources ahead of their first use.
+        :param names: resources to fetch, all of them by default
+        :param rate: maximum number of schema requests started per second
+        """
+        await self._load_resource_list()
+        names = [n for n in (self._resource_list if names is None else names)
+                 if n in self._resource_list and n not in self.resource_conf]
+
+        async def fetch(i, name):
+            await asyncio.sleep(i / rate if rate else 0.)
+            await self._fetch_resource_conf(name)
+
+        if names:
+            await asyncio.gather(*(fetch(i, name) for i, name in enumerate(names)))
+            self._save_stash()
+
+    async def _load_resource_list(self):
+        if self._resource_list is not None:
+            return
+        if not self._load_stash():
+            await self._fetch_resource_list()
+            self._save_stash()
+
+    async def _fetch_resource_list(self):
+        resource_list = (await self.get('/api/')).result
+        resource_list.pop('import', None)
+        self._resource_list = resource_list
+        self.resource_conf = {}
+        self._stash_time = time.time()
+
+    async def _fetch_resource_conf(self, name):
+        resource = self._resource_list[name]
+        try:
+            conf = (await self.get(resource['schema'])).result
+        except (HttpNotFound, HttpForbidden):
+            self._resource_list.pop(name, None)
+            return None
+        conf['list_endpoint'] = resource['list_endpoint']
+        conf['name'] = name
+        self.resource_conf[name] = conf
+        return conf
+
+    def resource_and_id_from_uri(self, path):
+        base_uri, id = re.match(r'^(.+?)(\d+)/$', path).groups()
+        for k, r in (self._resource_list or {}).items():
+            if r['list_endpoint'] == base_uri:
+                # Instances of resources not loaded yet are left unlinked
+                return (getattr(self, k) if k in self.resource_conf else None), id
+        return None, None
+
+    async def resource_from_uri(self, path):
+        if path:
+            if path.startswith(self.base_url):
+                path = path[len(self.base_url):]
+            await self._load_resource_list()
+            base_uri, id = re.match(r'^(.+?)(\d+)/$', path).groups()
+            for k, r in list(self._resource_list.items()):
+                if r['list_endpoint'] == base_uri:
+                    return await (await self.resource(k)).get(path)
+        return None
+
+    async def _send(self, method, url, data=None, params=None, headers=None, auth=None, **kwargs):
+        """
+        Sends a request through the aiohttp session. The request is prepared by requests
+        so that the auth classes sign it exactly as with ApiHelper, and the answer is
+        returned as a requests.Response.
+        """
+        prepared = requests.Request(method.upper(), url, data=data, params=params, headers=headers,
+                                    auth=auth).prepare()
+        session = self._get_session()
+        async with self._semaphore:
+            async with session.request(prepared.method, yarl.URL(prepared.url, encoded=True), data=prepared.body,
+                                       headers={k: str(v) for k, v in prepared.headers.items()},
+                                       **kwargs) as raw_response:
+                content = await raw_response.read()
+        response = requests.Response()
+        response.status_code = raw_response.status
+        response.headers = CaseInsensitiveDict(raw_response.headers)
+        response.url = str(raw_response.url)
+        response.reason = raw_response.reason
+        response.request = prepared
+        response._content = content
+        return response
+
+    async def _request(self, path, method, data=None, params=None, auth=None, headers=None, **kwargs):
+        url, data, params, req_headers, auth = self._prepare_request(path, data, params, auth, headers)
+        response = ApiResponse(await self._send(method, url, data, params, req_headers, auth, **kwargs), method)
+        if response.status_code >= 400:
+            self._throw_http_exception(response)
+        return response
+
+    async def oauth2_get_access_token(self, *args, **kwargs):
+        auth = super(AsyncApiHelper, self).oauth2_get_access_token(*args, **kwargs)
+        if asyncio.iscoroutine(auth):
+            auth = await auth
+        return auth
+
+    async def _fetch_oauth2_access_token(self, **kwargs):
+        return await self._post_oauth2_token(kwargs)
+
+    async def refresh_access_token(self, token=None):
+        """Refreshes the current OAuth2Token if possible."""
+        token = token or self.auth
+        data = {
+            'grant_type': 'refresh_token',
+            'refresh_token': token.refresh_token if isinstance(token, OAuth2Token) else token,
+        }
+        if not data['refresh_token']:
+            raise ValueError('Unable to find a refresh token.  Have you loaded an OAuth2 token yet?')
+        return await self._post_oauth2_token(data)
+
+    async def _post_oauth2_token(self, data):
+        basicauth = requests.auth.HTTPBasicAuth(self.api_key, self.api_secret)
+        response = await self._send('post', '%s/api/connect/oauth2/token/' % self.base_url, data=data, auth=basicauth)
+        if response.status_code >= 400:
+            self._throw_http_exception(response)
+        self.auth.set(**response.json())
+        return self.auth
+
+
+class AsyncHexoApi(AsyncApiHelper):
+
+    def __init__(self, api_key, api_secret, api_version='', auth=None, base_url=None, verify_ssl=True, pool_size=10,
+                 concurrency=10):
+        if base_url is None:
+            base_url = 'https://api.hexoskin.com'
+        super(AsyncHexoApi, self).__init__(api_key, api_secret, api_version, auth, base_url, verify_ssl, pool_size,
+                                           concurrency)
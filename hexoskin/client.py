@@ -4,26 +4,40 @@ import csv
 import datetime
 import hashlib
 import hmac
+import io
 import json
+import mmap
 import os
 import pickle
 import random
 import re
-import struct
 import sys
+import threading
 import time
-from collections import deque
+import warnings
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha1
-from urllib.parse import parse_qsl, urlparse, quote
+from http.cookiejar import DefaultCookiePolicy
+from itertools import islice
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse, quote
 
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 
 from .errors import (HttpBadRequest, ApiError, HttpUnauthorized, HttpForbidden, HttpNotFound, HttpMethodNotAllowed,
                      HttpInternalServerError, HttpNotImplemented, HttpError)
 
 strtypes = (str, bytes)
 CACHED_API_RESOURCE_LIST = '.api_stash'
+# Bump when the content of the stash changes, older stashes are then ignored
+RESOURCE_STASH_VERSION = 2
+RESOURCE_STASH_TTL = 24 * 3600
 DEFAULT_CONTENT_TYPE = 'application/json'
+# Samples of the binary data form, when the schema does not tell otherwise
+DEFAULT_DATA_DTYPE = '<i4'
+_ARRAY_SEPARATORS = str.maketrans('()[],', '     ')
 
 
 class ApiResourceAccessor(object):
@@ -37,25 +51,29 @@ class ApiResourceAccessor(object):
         self._conf = conf
         self.api = api
 
-    def list(self, get_args=None, format=None, auth=None, **kwargs):
+    def list(self, get_args=None, format=None, auth=None, stream=False, **kwargs):
+        """
+        :param stream: return CSV and binary answers as ApiCSVStream / ApiBinaryStream, read
+            as they are consumed instead of being loaded in memory
+        """
         self._verify_call('list', 'get')
         get_args = get_args or {}
         get_args.update(kwargs)
         get_args = self.api.convert_instances(get_args)
-        response = self.api.get(self._conf['list_endpoint'], get_args, auth=auth, **self._hdrs(format))
+        response = self.api.get(self._conf['list_endpoint'], get_args, auth=auth, stream=stream, **self._hdrs(format))
         return self._build_response(response)
 
     def patch(self, new_objects, auth=None, *args, **kwargs):
         self._verify_call('list', 'patch')
         return self.api.patch(self._conf['list_endpoint'], {'objects': new_objects}, auth=auth, *args, **kwargs)
 
-    def get(self, uri, format=None, auth=None, force_refresh=False):
+    def get(self, uri, format=None, auth=None, force_refresh=False, stream=False):
         self._verify_call('detail', 'get')
         if type(uri) is int or self._conf['list_endpoint'] not in uri:
             uri = '%s%s/' % (self._conf['list_endpoint'], uri)
         api_instance = self.api._object_cache.get(uri) if format != 'application/json' else None
         if force_refresh or not api_instance or api_instance._lazy:
-            response = self.api.get(uri, auth=auth, **self._hdrs(format))
+            response = self.api.get(uri, auth=auth, stream=stream, **self._hdrs(format))
             # if response.content_type == 'application/json':
             #     api_instance = self.api._object_cache.set(ApiResourceInstance(response.result, self))
             # else:
@@ -67,12 +85,11 @@ class ApiResourceAccessor(object):
         data = self.api.convert_instances(data)
         response = self.api.post(self.endpoint, data, auth=auth, *args, **kwargs)
         if response.result:
-            return self.api._object_cache.set(ApiResourceInstance(response.result, self))
+            return self.api._object_cache.set(self._instance(response.result))
         else:
             uri = response.headers['Location']
             rsrc_type, id = self.api.resource_and_id_from_uri(uri)
-            return self._parent.api._object_cache.set(
-                ApiResourceInstance({'resource_uri': v, 'id': id}, self, lazy=True))
+            return self._parent.api._object_cache.set(self._instance({'resource_uri': v, 'id': id}, lazy=True))
 
     @property
     def endpoint(self):
@@ -90,13 +107,19 @@ class ApiResourceAccessor(object):
             else:
                 # Lame detection of list results
                 if response.result.get('meta', {}).keys() > {'limit', 'next', 'previous'}:
-                    return ApiResourceList(response, self)
+                    return self._build_list(response)
                 else:
-                    return self.api._object_cache.set(ApiResourceInstance(response.result, self))
+                    return self.api._object_cache.set(self._instance(response.result))
         elif ctype == 'text/csv':
-            return ApiCSVResult(response, self)
+            return ApiCSVStream(response, self) if response.stream else ApiCSVResult(response, self)
         else:
-            return ApiBinaryResult(response, self)
+            return ApiBinaryStream(response, self) if response.stream else ApiBinaryResult(response, self)
+
+    def _build_list(self, response):
+        return ApiResourceList(response, self)
+
+    def _instance(self, obj, lazy=False):
+        return ApiResourceInstance(obj, self, lazy=lazy)
 
     def _hdrs(self, format=None):
         return {'headers': {'Accept': format}} if format else {}
@@ -143,6 +166,64 @@ class ApiBinaryResult(ApiResult, bytearray):
         bytearray.__init__(self, response.result)
 
 
+class ApiBinaryStream(ApiResult):
+    """
+    Binary answer read from the connection as it is consumed, so memory stays
+    constant whatever its size. It can be iterated once, as chunks of bytes, or
+    written to a file.
+    """
+
+    chunk_size = 1 << 16
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def iter_chunks(self, chunk_size=None):
+        return self.response.iter_content(chunk_size or self.chunk_size)
+
+    def save(self, file_path, chunk_size=None):
+        """Writes the answer to file_path chunk by chunk and returns file_path."""
+        tmp_path = '%s.%s.part' % (file_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in self.iter_chunks(chunk_size):
+                    f.write(chunk)
+            os.replace(tmp_path, file_path)
+        finally:
+            self.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return file_path
+
+    def mmap(self, file_path, chunk_size=None):
+        """Saves the answer to file_path and returns a read-only memory map of it."""
+        with open(self.save(file_path, chunk_size), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.response.close()
+
+
+class ApiCSVStream(ApiBinaryStream):
+    """CSV answer iterated row by row as it is received."""
+
+    def __iter__(self):
+        return self.iter_rows()
+
+    def iter_rows(self):
+        raw = self.response.raw
+        raw.decode_content = True  # Undo any gzip transfer encoding
+        raw.auto_close = False  # Let the text wrapper see the end of the stream before it is closed
+        text = io.TextIOWrapper(raw, encoding=self.response.encoding or 'utf-8', newline='')
+        try:
+            for row in csv.reader(text):
+                yield row
+        finally:
+            self.close()
+
+
 class ApiResultList(ApiResult, deque):
 
     def __init__(self, response, parent):
@@ -165,7 +246,7 @@ class ApiDataList(ApiResultList):
 class ApiDataResult(object):
 
     def __init__(self, row, parent):
-        self.record = [ApiResourceInstance(r, parent.api.record) for r in row.get('record', [])]
+        self.record = [parent.api.record._instance(r) for r in row.get('record', [])]
         self.user = row['user']
         self.data = {int(d): v for d, v in row['data'].items()}
 
@@ -182,38 +263,78 @@ class ApiResourceList(ApiResultList):
         super(ApiResourceList, self).__init__(response, parent)
         self._set_next_prev(response)
 
-    def iter_all(self):
+    def iter_all(self, workers=2, depth=None):
         """
         Get a list all the elements of a call through a generator
         The elements are fetched on the api as needed. This is useful to limit memory usage
+        :param workers: number of pages downloaded at the same time
+        :param depth: number of pages read ahead of the one being consumed, defaults to workers.
+            At most depth pages are held in memory besides the current one.
         """
+        pages = self._iter_pages(workers, depth)
         i = 0
         while i < self.response.result['meta']['total_count']:
             if len(self) == 0:
-                self.load_next()
+                response = next(pages, None)
+                if response is None:
+                    return
+                self._append_response(response)
             i += 1
             yield self.popleft()
 
-    def prefetch_all(self):
+    def prefetch_all(self, workers=4):
         """
         Get a list all the elements of a query.
-        This call the "next" api address until all the data are downloaded.
-        Note: this will make many fast calls to the api. The api may not allow it.
+        The remaining pages are downloaded by workers concurrent requests and appended in order.
+        Note: this will make many fast calls to the api. The api may not allow it, use workers=1 then.
         Note: This can create memory issues if more than 1000 values are downloaded. See iter_all
         """
-
-        while True:
-            try:
-                self.load_next()
-            except StopIteration:
-                break
+        for response in self._iter_pages(workers):
+            self._append_response(response)
         return self
 
+    def _page_urls(self):
+        """
+        Urls of the pages after the ones already loaded, computed from meta.total_count
+        and the offset of the next url. None if the api did not return enough to compute them.
+        """
+        meta = self.response.result['meta']
+        if not self.nexturl:
+            return []
+        parsed = urlparse(self.nexturl)
+        query = parse_qsl(parsed.query, keep_blank_values=True)
+        offsets = [int(v) for k, v in query if k == 'offset']
+        if not offsets or not meta.get('limit') or meta.get('total_count') is None:
+            return None
+        query = [(k, v) for k, v in query if k != 'offset']
+        return [urlunparse(parsed._replace(query=urlencode(query + [('offset', offset)])))
+                for offset in range(offsets[0], meta['total_count'], meta['limit'])]
+
+    def _iter_pages(self, workers=4, depth=None):
+        """
+        Yields the responses of the remaining pages in order. Up to depth pages are
+        requested ahead, by workers threads. Falls back to following the next urls one
+        at a time when the page urls cannot be computed.
+        """
+        urls = self._page_urls()
+        if urls is None:
+            while self.nexturl:
+                yield self._parent.api.get(self.nexturl)
+            return
+        urls = iter(urls)
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            pending = deque(executor.submit(self._parent.api.get, url)
+                            for url in islice(urls, max(1, depth or workers)))
+            while pending:
+                response = pending.popleft().result()
+                pending.extend(executor.submit(self._parent.api.get, url) for url in islice(urls, 1))
+                yield response
+
     def _make_list(self, response):
         return map(self._make_list_item, response.result['objects'])
 
     def _make_list_item(self, r):
-        return self._parent.api._object_cache.set(ApiResourceInstance(r, self._parent))
+        return self._parent.api._object_cache.set(self._parent._instance(r))
 
     def __delitem__(self, key):
         self[key].delete()
@@ -273,7 +394,7 @@ class ApiResourceInstance(object):
                 if isinstance(v, dict):
                     rsrc_type, id = self._parent.api.resource_and_id_from_uri(v.get('resource_uri', ''))
                     if rsrc_type:
-                        self.fields[k] = self._parent.api._object_cache.set(ApiResourceInstance(v, rsrc_type))
+                        self.fields[k] = self._parent.api._object_cache.set(rsrc_type._instance(v))
 
                 elif isinstance(v, strtypes):
                     rsrc_type, id = self._parent.api.resource_and_id_from_uri(v)
@@ -283,7 +404,7 @@ class ApiResourceInstance(object):
                         # If not, create a lazy one.
                         if not rsrc:
                             rsrc = self._parent.api._object_cache.set(
-                                ApiResourceInstance({'resource_uri': v, 'id': id}, rsrc_type, lazy=True))
+                                rsrc_type._instance({'resource_uri': v, 'id': id}, lazy=True))
                         self.fields[k] = rsrc
 
     def __getattr__(self, name):
@@ -327,25 +448,75 @@ class ApiResourceInstance(object):
 
     def _decode_data(self):
         if not hasattr(self, '_decoded_data'):
-            self._decoded_data = None
-            for fn in (self._decode_binary, self._decode_array):
-                try:
-                    self._decoded_data = fn(self.fields['data'])
-                    break
-                except Exception:
-                    pass
+            self._decoded_data = self.decode_data()
         return self._decoded_data
 
-    def _decode_binary(self, data):
-        return struct.unpack('i' * self.nsample, base64.b64decode(data))
+    def decode_data(self, format=None, dtype=None):
+        """
+        Decodes the data field into a numpy array.
+        :param format: 'binary' for base64 encoded samples, 'array' for the "(a, b), (c, d)" text
+            form, None to tell them apart from the first character
+        :param dtype: dtype of the binary samples, including their byte order. Defaults to the
+            'dtype' and 'byteorder' of the data field in the schema, else DEFAULT_DATA_DTYPE.
+        :return: 1D array of samples for 'binary', 2D array with one row per tuple for 'array'
+        """
+        data = self.fields['data']
+        if data is None:
+            return None
+        if format is None:
+            format = 'array' if isinstance(data, strtypes) and data.lstrip()[:1] in ('(', '[', b'(', b'[') \
+                else 'binary'
+        if format == 'binary':
+            return self._decode_binary(data, dtype)
+        elif format == 'array':
+            return self._decode_array(data)
+        raise ValueError("Unknown data format '%s', expected 'binary' or 'array'" % format)
+
+    def _data_dtype(self):
+        field = self._parent._conf.get('fields', {}).get('data', {})
+        dtype = np.dtype(field.get('dtype', DEFAULT_DATA_DTYPE))
+        byteorder = {'little': '<', 'big': '>'}.get(field.get('byteorder'), field.get('byteorder'))
+        if byteorder in ('<', '>'):
+            dtype = dtype.newbyteorder(byteorder)
+        return dtype
+
+    def _decode_binary(self, data, dtype=None):
+        # A view on the decoded buffer, without copy
+        buffer = base64.b64decode(data)
+        dtype = np.dtype(dtype) if dtype is not None else self._data_dtype()
+        nsample = self.fields.get('nsample')
+        try:
+            return np.frombuffer(buffer, dtype=dtype, count=-1 if nsample is None else nsample)
+        except ValueError as e:
+            raise ApiError('Cannot decode %s bytes of data as %s samples of %s: %s' % (
+                len(buffer), nsample, dtype, e))
 
     def _decode_array(self, data):
-        return [tuple(int(i) for i in v.split(',')) for v in data.strip('()[]').split('), (')]
+        if isinstance(data, bytes):
+            data = data.decode()
+        data = data.strip()
+        first = data.lstrip('[(').split(')', 1)[0]
+        width = first.count(',') + 1 if '(' in data else 1
+        text = data.translate(_ARRAY_SEPARATORS)
+        dtype = np.float64 if '.' in text or 'e' in text else np.int64
+        if not text.strip():
+            return np.zeros((0, width), dtype=dtype)
+        # Parsed in C. Older numpy stop at the first value they cannot read, hence the count check
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', DeprecationWarning)
+                values = np.fromstring(text, dtype=dtype, sep=' ')
+        except ValueError:
+            values = None
+        if values is None or len(values) != data.count(',') + 1 or len(values) % width:
+            raise ApiError('Cannot decode data as tuples of %s values: %s...' % (width, data[:64]))
+        return values.reshape(-1, width)
 
 
 class ApiHelper(object):
 
-    def __init__(self, api_key=None, api_secret=None, api_version='', auth=None, base_url=None, verify_ssl=True):
+    def __init__(self, api_key=None, api_secret=None, api_version='', auth=None, base_url=None, verify_ssl=True,
+                 pool_size=10, http_cache=None):
         """
         :param api_key: public key
         :param api_secret: private key
@@ -353,13 +524,25 @@ class ApiHelper(object):
         :param auth: HTTPBasicAuth, HexoAuth, OAuth1Token, OAuth2Token, "username:password"
         :param base_url:
         :param verify_ssl:
+        :param pool_size: number of keep-alive connections kept open to the api
+        :param http_cache: revalidate GET responses with ETag / Last-Modified instead of downloading
+            them again. True for an in-memory cache, a directory to also keep it on disk, or an
+            ApiHttpCache
         """
 
         super(ApiHelper, self).__init__()
         self.resource_conf = {}
         self.resources = {}
+        self._resource_list = None
+        self._stash_time = None
         self._resource_cache = None
         self._object_cache = ApiObjectCache(self)
+        self.session = self._create_session(pool_size)
+        if http_cache is True:
+            http_cache = ApiHttpCache()
+        elif isinstance(http_cache, strtypes):
+            http_cache = ApiHttpCache(cache_dir=http_cache)
+        self.http_cache = http_cache or None
 
         self.api_key = api_key
         self.api_secret = api_secret
@@ -377,40 +560,118 @@ class ApiHelper(object):
         return 256 if '/api.hexoskin.com' in self.base_url else 1000
 
     def __getattr__(self, name):
-        if len(self.resources) == 0:
-            self.build_resources()
+        # Never an endpoint, and keeps copy/pickle lookups from hitting the api
+        if name.startswith('_'):
+            raise AttributeError(name)
         if name in self.resources:
             return self.resources[name]
+        self._load_resource_list()
+        if name not in self.resource_conf and name in self._resource_list:
+            # Only the schemas of the resources actually used are fetched
+            self._fetch_resource_conf(name)
+            self._save_stash()
         if name in self.resource_conf:
             self.resources[name] = ApiResourceAccessor(name, self.resource_conf[name], self)
             return self.resources[name]
         else:
             raise AttributeError("'%s' is not a valid API endpoint" % name)
 
+    def _create_session(self, pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        # Connections are reused, but requests stay stateless: no cookie is kept between them
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        return session
+
+    def close(self):
+        """Closes the pooled connections."""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def clear_resource_cache(self):
         if self._resource_cache is not None:
             if os.path.isfile(self._resource_cache):
                 os.remove(self._resource_cache)
                 self.resources = {}
                 self.resource_conf = {}
+                self._resource_list = None
 
     def clear_object_cache(self):
         self._object_cache.clear()
 
-    def build_resources(self):
-        if self._resource_cache is not None:
-            try:
-                with open(self._resource_cache, 'rb') as f:
-                    self.resource_conf = pickle.load(f)
-            except IOError:
-                self._fetch_resource_list()
-                try:
-                    with open(self._resource_cache, 'wb+') as f:
-                        pickle.dump(self.resource_conf, f)
-                except IOError as e:
-                    print("Couldn't write to stash file: %s" % e)
-        else:
+    def build_resources(self, workers=4, rate=3.):
+        """Fetches the schemas of all the resources, see warm_up."""
+        self.warm_up(workers=workers, rate=rate)
+
+    def warm_up(self, names=None, workers=4, rate=3.):
+        """
+        Fetches the schemas of many resources ahead of their first use.
+        :param names: resources to fetch, all of them by default
+        :param workers: number of schemas fetched at the same time
+        :param rate: maximum number of schema requests per second
+        """
+        self._load_resource_list()
+        names = [n for n in (self._resource_list if names is None else names)
+                 if n in self._resource_list and n not in self.resource_conf]
+        if not names:
+            return
+        limiter = _RateLimiter(rate)
+
+        def fetch(name):
+            limiter.wait()
+            return self._fetch_resource_conf(name)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            list(executor.map(fetch, names))
+        self._save_stash()
+
+    def _load_resource_list(self):
+        if self._resource_list is not None:
+            return
+        if not self._load_stash():
             self._fetch_resource_list()
+            self._save_stash()
+
+    def _load_stash(self):
+        if self._resource_cache is None:
+            return False
+        try:
+            with open(self._resource_cache, 'rb') as f:
+                stash = pickle.load(f)
+            if stash['version'] != RESOURCE_STASH_VERSION or time.time() - stash['time'] > RESOURCE_STASH_TTL:
+                return False
+            self._resource_list = stash['resource_list']
+            self.resource_conf = stash['resource_conf']
+            self._stash_time = stash['time']
+        except Exception:
+            # Missing, truncated, corrupted or from an older version: fetch again
+            return False
+        return True
+
+    def _save_stash(self):
+        if self._resource_cache is None:
+            return
+        stash = {
+            'version': RESOURCE_STASH_VERSION,
+            'time': self._stash_time,
+            'resource_list': self._resource_list,
+            'resource_conf': self.resource_conf,
+        }
+        try:
+            # Write then rename so concurrent readers never see a partial stash
+            tmp_path = '%s.%s.tmp' % (self._resource_cache, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(stash, f)
+            os.replace(tmp_path, self._resource_cache)
+        except IOError as e:
+            print("Couldn't write to stash file: %s" % e)
 
     def _create_auth(self, auth, key=None, secret=None):
         """
@@ -435,17 +696,23 @@ class ApiHelper(object):
 
     def _fetch_resource_list(self):
         resource_list = self.get('/api/').result
-        for n, r in resource_list.items():
-            if n == 'import':
-                continue
-            try:
-                self.resource_conf[n] = self.get(r['schema']).result
-                self.resource_conf[n]['list_endpoint'] = r['list_endpoint']
-                self.resource_conf[n]['name'] = n
-            except (HttpNotFound, HttpForbidden) as e:
-                # Continue if a resource listed in /api/ is unavailable.
-                pass
-            time.sleep(.3)
+        resource_list.pop('import', None)
+        self._resource_list = resource_list
+        self.resource_conf = {}
+        self._stash_time = time.time()
+
+    def _fetch_resource_conf(self, name):
+        resource = self._resource_list[name]
+        try:
+            conf = self.get(resource['schema']).result
+        except (HttpNotFound, HttpForbidden) as e:
+            # A resource listed in /api/ is unavailable, forget it.
+            self._resource_list.pop(name, None)
+            return None
+        conf['list_endpoint'] = resource['list_endpoint']
+        conf['name'] = name
+        self.resource_conf[name] = conf
+        return conf
 
     def _parse_base_url(self, base_url):
         parsed = urlparse(base_url)
@@ -472,7 +739,8 @@ class ApiHelper(object):
             return int(time.mktime(v.timetuple())) * 256
         return v
 
-    def _request(self, path, method, data=None, params=None, auth=None, headers=None, **kwargs):
+    def _prepare_request(self, path, data=None, params=None, auth=None, headers=None):
+        """Url, body, query, headers and auth of a request to the api."""
         auth = self._create_auth(auth) if auth else self.auth
         if params:
             # Make lists or sets comma-separated strings.
@@ -485,13 +753,34 @@ class ApiHelper(object):
             req_headers.update(headers)
         if data and not isinstance(data, strtypes) and req_headers['Content-type'] == 'application/json':
             data = json.dumps(data)
+        return url, data, params, req_headers, auth
+
+    def _request(self, path, method, data=None, params=None, auth=None, headers=None, **kwargs):
+        url, data, params, req_headers, auth = self._prepare_request(path, data, params, auth, headers)
         kwargs.setdefault('verify', self.verify_ssl)
-        response = ApiResponse(
-            requests.request(method, url, data=data, params=params, headers=req_headers, auth=auth, **kwargs), method)
+        cache_key = cache_entry = None
+        if self.http_cache is not None and method == 'get' and not kwargs.get('stream'):
+            cache_key = self.http_cache.key(url, params, req_headers.get('Accept'), auth,
+                                            req_headers.get('Authorization'))
+            cache_entry = self.http_cache.get(cache_key) if cache_key is not None else None
+            if cache_entry is not None:
+                req_headers.update(self.http_cache.validators(cache_entry))
+        raw_response = self.session.request(method, url, data=data, params=params, headers=req_headers, auth=auth,
+                                            **kwargs)
+        if cache_entry is not None and raw_response.status_code == 304:
+            raw_response = self.http_cache.rebuild(raw_response, cache_entry)
+        elif cache_key is not None and raw_response.status_code == 200:
+            self.http_cache.set(cache_key, raw_response)
+        response = ApiResponse(raw_response, method, stream=kwargs.get('stream', False))
         if response.status_code >= 400:
             self._throw_http_exception(response)
         return response
 
+    def download(self, path, file_path, data=None, auth=None, headers=None, chunk_size=1 << 16):
+        """Streams the answer of a GET directly to file_path, in constant memory, and returns file_path."""
+        response = self.get(path, data, auth=auth, headers=headers, stream=True)
+        return ApiBinaryStream(response, None).save(file_path, chunk_size)
+
     def post(self, path, data=None, auth=None, headers=None, **kwargs):
         return self._request(path, 'post', data, auth=auth, headers=headers, **kwargs)
 
@@ -518,7 +807,8 @@ class ApiHelper(object):
 
     def resource_and_id_from_uri(self, path):
         base_uri, id = re.match('^(.+?)(\d+)/$', path).groups()
-        for k, r in self.resource_conf.items():
+        self._load_resource_list()
+        for k, r in list(self._resource_list.items()):
             if r['list_endpoint'] == base_uri:
                 return getattr(self, k), id
         return None, None
@@ -604,7 +894,8 @@ class ApiHelper(object):
 
     def _fetch_oauth2_access_token(self, **kwargs):
         basicauth = requests.auth.HTTPBasicAuth(self.api_key, self.api_secret)
-        response = requests.post('%s/api/connect/oauth2/token/' % self.base_url, data=kwargs, auth=basicauth)
+        response = self.session.post('%s/api/connect/oauth2/token/' % self.base_url, data=kwargs, auth=basicauth,
+                                     verify=self.verify_ssl)
         if response.status_code >= 400:
             self._throw_http_exception(response)
         self.auth.set(**response.json())
@@ -620,13 +911,31 @@ class ApiHelper(object):
         if not data['refresh_token']:
             raise ValueError('Unable to find a refresh token.  Have you loaded an OAuth2 token yet?')
         basicauth = requests.auth.HTTPBasicAuth(self.api_key, self.api_secret)
-        response = requests.post('%s/api/connect/oauth2/token/' % self.base_url, data=data, auth=basicauth)
+        response = self.session.post('%s/api/connect/oauth2/token/' % self.base_url, data=data, auth=basicauth,
+                                     verify=self.verify_ssl)
         if response.status_code >= 400:
             self._throw_http_exception(response)
         self.auth.set(**response.json())
         return self.auth
 
 
+class _RateLimiter(object):
+    """Spaces the calls to wait() of any number of threads by at least 1 / rate seconds."""
+
+    def __init__(self, rate):
+        self.interval = 1. / rate if rate else 0.
+        self._next = 0.
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
 class HexoAuth(requests.auth.HTTPBasicAuth):
     """
     Supports BasicAuth and Hexo signatures.
@@ -768,7 +1077,8 @@ class OAuth2Token(object):
 
 class HexoApi(ApiHelper):
 
-    def __init__(self, api_key, api_secret, api_version='', auth=None, base_url=None, verify_ssl=True):
+    def __init__(self, api_key, api_secret, api_version='', auth=None, base_url=None, verify_ssl=True, pool_size=10,
+                 http_cache=None):
         """
         :param api_key: public key
         :param api_secret: private key
@@ -776,10 +1086,13 @@ class HexoApi(ApiHelper):
         :param auth: HTTPBasicAuth, HexoAuth, OAuth1Token, OAuth2Token, 'username:password"
         :param base_url:
         :param verify_ssl:
+        :param pool_size: number of keep-alive connections kept open to the api
+        :param http_cache: True, a directory or an ApiHttpCache to revalidate GET responses, see ApiHelper
         """
         if base_url is None:
             base_url = 'https://api.hexoskin.com'
-        return super(HexoApi, self).__init__(api_key, api_secret, api_version, auth, base_url, verify_ssl)
+        return super(HexoApi, self).__init__(api_key, api_secret, api_version, auth, base_url, verify_ssl, pool_size,
+                                             http_cache)
 
 
 class ApiResponse(object):
@@ -789,14 +1102,21 @@ class ApiResponse(object):
     functional one.  It's here for compatibility now.  TODO: remove.
     """
 
-    def __init__(self, response, method='GET'):
+    def __init__(self, response, method='GET', stream=False):
 
-        if ('application/json' in response.headers['Content-Type'] 
-           or 'application_json' in response.headers[  'Content-Type']) and len(response.content):
-            self.result = response.json()
+        is_json = ('application/json' in response.headers['Content-Type']
+                   or 'application_json' in response.headers['Content-Type'])
+        # Only successful non-JSON answers are left unread when streaming
+        self.stream = stream and not is_json and response.status_code < 400
+        if self.stream:
+            self.result = None
+            self.body = None
         else:
-            self.result = response.content
-        self.body = response.content
+            if is_json and len(response.content):
+                self.result = response.json()
+            else:
+                self.result = response.content
+            self.body = response.content
         self.url = response.request.url
         self.method = method.upper()
         self.response = response
@@ -816,46 +1136,209 @@ class ApiResponse(object):
 
 
 class ApiObjectCache(object):
+    """
+    LRU cache of the ApiResourceInstances by uri. Entries expire ttl seconds after
+    they were last set, and the least recently used ones are evicted beyond max_size.
+    Expired entries are dropped a few at a time on every call, from oldest to newest.
+    """
 
-    def __init__(self, api, ttl=3600):
+    def __init__(self, api, ttl=3600, max_size=10000):
         self.api = api
         self.ttl = ttl
-        self._objects = {}
-        self._keys = self._objects.keys()
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._objects = OrderedDict()
+        # (time, uri) in the order entries were set, some may be outdated by a later set
+        self._expiry = deque()
 
     def get(self, uri):
+        self._expire()
         uri = self._strip_host(uri)
         obj = self._objects.get(uri, None)
         if obj:
             if time.time() - obj[0] < self.ttl:
+                self._objects.move_to_end(uri)
+                self.hits += 1
                 return obj[1]
             else:
                 del self._objects[uri]
+                self.expirations += 1
+        self.misses += 1
         return None
 
     def set(self, obj):
         try:
-            uri = obj.resource_uri
+            uri = self._strip_host(obj.resource_uri)
         except AttributeError:
             return obj
+        self._expire()
+        now = time.time()
         if uri in self._objects:
             self._objects[uri][1].update_fields(obj.fields)
-            return self._objects[uri][1]
-        else:
-            self._objects[uri] = (time.time(), obj)
-            return obj
-
-    def clear(self, uri):
+            obj = self._objects[uri][1]
+        self._objects[uri] = (now, obj)
+        self._objects.move_to_end(uri)
+        self._expiry.append((now, uri))
+        while len(self._objects) > self.max_size:
+            self._objects.popitem(last=False)
+            self.evictions += 1
+        return obj
+
+    def clear(self, uri=None):
+        """Removes uri from the cache, or everything without uri."""
+        if uri is None:
+            self._objects.clear()
+            self._expiry.clear()
+            return
         uri = self._strip_host(uri)
         if uri in self._objects:
             del self._objects[uri]
 
+    def stats(self):
+        return {'size': len(self._objects), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations}
+
+    def __len__(self):
+        return len(self._objects)
+
+    def _expire(self, max_checks=8):
+        """Drops up to max_checks of the oldest entries if they expired, O(1) amortised."""
+        deadline = time.time() - self.ttl
+        for _ in range(max_checks):
+            if not self._expiry or self._expiry[0][0] > deadline:
+                break
+            set_time, uri = self._expiry.popleft()
+            obj = self._objects.get(uri)
+            # Skip the entries evicted, cleared or set again since
+            if obj is not None and obj[0] == set_time:
+                del self._objects[uri]
+                self.expirations += 1
+        # Outdated (time, uri) pairs must not outgrow the cache itself
+        if len(self._expiry) > 2 * self.max_size + 64:
+            self._expiry = deque(sorted((t, u) for u, (t, o) in self._objects.items()))
+
     def _strip_host(self, uri):
         if uri.startswith(self.api.base_url):
             uri = uri[len(self.api.base_url):]
         return uri
 
 
+class ApiHttpCache(object):
+    """
+    Bodies of the GET responses that carry an ETag or a Last-Modified header, by user,
+    url and Accept header. The next GET of the same url sends them back as If-None-Match /
+    If-Modified-Since, and a 304 answer is rebuilt from the stored body. The max_size
+    most recently used entries are kept in memory, and all of them in cache_dir if given.
+    Thread safe, the page prefetch and warm_up threads share it.
+    """
+
+    def __init__(self, cache_dir=None, max_size=1000):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.revalidated = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, url, params=None, accept=None, auth=None, authorization=None):
+        """
+        Key of a GET, or None if it must not be cached. The identity of auth and the
+        Authorization header are part of the key, so users never share an entry.
+        """
+        identity = self.auth_identity(auth)
+        if identity is None:
+            return None
+        url = requests.Request('GET', url, params=params).prepare().url
+        return hashlib.sha1(('%s %s %s %s' % (identity, authorization, accept, url)).encode('utf8')).hexdigest()
+
+    @staticmethod
+    def auth_identity(auth):
+        """User name or token of auth, None for auth classes whose user is unknown."""
+        if auth is None:
+            return ''
+        if isinstance(auth, requests.auth.HTTPBasicAuth):
+            return 'basic %s %s' % (getattr(auth, 'api_key', None), auth.username)
+        if isinstance(auth, OAuth2Token):
+            return 'oauth2 %s' % getattr(auth, 'access_token', None)
+        if isinstance(auth, OAuth1Token):
+            return 'oauth1 %s %s' % (auth.oauth_consumer_key, getattr(auth, 'oauth_token', None))
+        return None
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+            if self.cache_dir is None:
+                return None
+            try:
+                with open(self._path(key), 'rb') as f:
+                    entry = pickle.load(f)
+            except Exception:
+                # Missing or unreadable entry, the response is downloaded again
+                return None
+            self._remember(key, entry)
+            return entry
+
+    def set(self, key, response):
+        entry = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'content_type': response.headers.get('Content-Type', ''),
+            'body': response.content,
+        }
+        if not entry['etag'] and not entry['last_modified']:
+            return
+        with self._lock:
+            self._remember(key, entry)
+            if self.cache_dir is not None:
+                try:
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    tmp_path = '%s.%s.tmp' % (self._path(key), os.getpid())
+                    with open(tmp_path, 'wb') as f:
+                        pickle.dump(entry, f)
+                    os.replace(tmp_path, self._path(key))
+                except IOError as e:
+                    print("Couldn't write to http cache: %s" % e)
+
+    def validators(self, entry):
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def rebuild(self, response, entry):
+        """Turns a 304 response into the 200 response it stands for."""
+        with self._lock:
+            self.revalidated += 1
+        response.status_code = 200
+        response.headers['Content-Type'] = entry['content_type']
+        response._content = entry['body']
+        return response
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self.cache_dir is not None and os.path.isdir(self.cache_dir):
+                for name in os.listdir(self.cache_dir):
+                    os.remove(os.path.join(self.cache_dir, name))
+
+    def _remember(self, key, entry):
+        # Called with the lock held
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+
 def oauth_parse_qs(url, fragment=False):
     """
     Accepts either an URL or just the query string, or optionally will look
@@ -18,6 +18,9 @@ parser.add_option("-d", "--duration",
 parser.add_option("-f", "--filename",
                   dest="filename", type='str', default=default_fname,
                   help="Name of the recording file.")
+parser.add_option("-p", "--pyramid",
+                  dest="pyramid", action="store_true", default=False,
+                  help="Build the min/max pyramid of the recording while recording.")
 
 # dejitter timestamps
 dejitter = False
@@ -46,6 +49,13 @@ for i in range(1, Nchan):
     ch = ch.next_sibling()
     ch_names.append(ch.child_value('label'))
 
+pyramid = None
+if options.pyramid:
+    # Imported here so recording does not need the BLE stack pulled in by the muse package
+    from muse.pyramid import PyramidWriter, pyramid_path
+    pyramid = PyramidWriter(pyramid_path(options.filename), Nchan,
+                            sfreq=freq, ch_names=ch_names)
+
 res = []
 timestamps = []
 t_init = time()
@@ -56,9 +66,14 @@ while (time() - t_init) < options.duration:
         if timestamp:
             res.append(data)
             timestamps.extend(timestamp)
+            if pyramid is not None:
+                pyramid.push(np.array(data).T, timestamp)
     except KeyboardInterrupt:
         break
 
+if pyramid is not None:
+    pyramid.close()
+
 res = np.concatenate(res, axis=0)
 timestamps = np.array(timestamps)
 
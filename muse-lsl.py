@@ -1,4 +1,7 @@
 from muse import Muse
+from muse.features import BandPowerEngine
+from muse.filters import StreamingFilter
+from muse.quality import SignalQualityMonitor
 from time import sleep
 from pylsl import StreamInfo, StreamOutlet, local_clock
 from optparse import OptionParser
@@ -16,26 +19,117 @@ parser.add_option("-b", "--backend",
 parser.add_option("-i", "--interface",
                   dest="interface", type='string', default=None,
                   help="The interface to use, 'hci0' for gatt or a com port for bgapi")
+parser.add_option("-p", "--bandpower",
+                  dest="bandpower", action="store_true", default=False,
+                  help="also publish band powers as a second LSL stream.")
+parser.add_option("-r", "--bandpower-rate",
+                  dest="bandpower_rate", type='float', default=2.,
+                  help="rate in Hz of the band power stream.")
+parser.add_option("--notch",
+                  dest="notch", type='float', default=None,
+                  help="frequency of the line noise notch filter, e.g. 60.")
+parser.add_option("--bandpass",
+                  dest="bandpass", type='string', default=None,
+                  help="band-pass corners 'low,high', either may be empty.")
+parser.add_option("--filter-consumers",
+                  dest="filter_consumers", type='string',
+                  default="eeg,bandpower",
+                  help="consumers fed with filtered data: eeg, bandpower.")
+parser.add_option("-q", "--quality",
+                  dest="quality", action="store_true", default=False,
+                  help="also publish per-channel quality scores as a LSL stream.")
+parser.add_option("--line-freq",
+                  dest="line_freq", type='float', default=60.,
+                  help="power line frequency used by the quality monitor.")
 
 (options, args) = parser.parse_args()
 
+stream_filter = None
+filter_consumers = []
+if options.notch is not None or options.bandpass is not None:
+    bandpass = None
+    if options.bandpass is not None:
+        bandpass = tuple(float(f) if f else None
+                         for f in options.bandpass.split(','))
+    stream_filter = StreamingFilter(n_channels=5, sfreq=256.,
+                                    notch=options.notch, bandpass=bandpass)
+    filter_consumers = options.filter_consumers.split(',')
+
+ch_names = ['TP9', 'AF7', 'AF8', 'TP10', 'Right AUX']
+
 info = info = StreamInfo('Muse', 'EEG', 5, 256, 'float32',
                          'Muse%s' % options.address)
 
 info.desc().append_child_value("manufacturer", "Muse")
 channels = info.desc().append_child("channels")
 
-for c in ['TP9', 'AF7', 'AF8', 'TP10', 'Right AUX']:
+for c in ch_names:
     channels.append_child("channel") \
         .append_child_value("label", c) \
         .append_child_value("unit", "microvolts") \
         .append_child_value("type", "EEG")
 outlet = StreamOutlet(info, 12, 360)
 
+engine = None
+if options.bandpower:
+    def push_bandpower(powers, timestamp):
+        bp_outlet.push_sample(powers.ravel(), timestamp)
+
+    engine = BandPowerEngine(callback=push_bandpower, n_channels=5,
+                             sfreq=256., rate=options.bandpower_rate)
+
+    bp_info = StreamInfo('MuseBandPower', 'BandPower',
+                         5 * len(engine.bands), engine.rate, 'float32',
+                         'MuseBandPower%s' % options.address)
+    bp_info.desc().append_child_value("manufacturer", "Muse")
+    bp_channels = bp_info.desc().append_child("channels")
+    for c in ch_names:
+        for band in engine.band_names:
+            bp_channels.append_child("channel") \
+                .append_child_value("label", '%s_%s' % (c, band)) \
+                .append_child_value("unit", "microvolts^2") \
+                .append_child_value("type", "BandPower")
+    bp_outlet = StreamOutlet(bp_info, 1, 360)
+
+monitor = None
+if options.quality:
+    def push_quality(scores, flags, timestamp):
+        q_outlet.push_sample(scores, timestamp)
+
+    def report_change(channel, flags, timestamp):
+        print('%s quality flags: %d' % (ch_names[channel], flags))
+
+    monitor = SignalQualityMonitor(callback=push_quality,
+                                   on_change=report_change, n_channels=5,
+                                   sfreq=256., line_freq=options.line_freq)
+
+    q_info = StreamInfo('MuseQuality', 'Quality', 5, monitor.rate,
+                        'float32', 'MuseQuality%s' % options.address)
+    q_info.desc().append_child_value("manufacturer", "Muse")
+    q_channels = q_info.desc().append_child("channels")
+    for c in ch_names:
+        q_channels.append_child("channel") \
+            .append_child_value("label", c) \
+            .append_child_value("unit", "score") \
+            .append_child_value("type", "Quality")
+    q_outlet = StreamOutlet(q_info, 1, 360)
+
 
 def process(data, timestamps):
+    # filter once, then hand raw or filtered data to each consumer
+    filtered = data
+    if stream_filter is not None:
+        filtered = stream_filter.filter(data)
+
+    eeg = filtered if 'eeg' in filter_consumers else data
     for ii in range(12):
-        outlet.push_sample(data[:, ii], timestamps[ii])
+        outlet.push_sample(eeg[:, ii], timestamps[ii])
+    if engine is not None:
+        bp = filtered if 'bandpower' in filter_consumers else data
+        engine.push(bp, timestamps)
+    if monitor is not None:
+        # quality is assessed on the raw signal, where rails are visible
+        monitor.push(data, timestamps)
 
 muse = Muse(address=options.address, callback=process,
             backend=options.backend, time_func=local_clock,
@@ -0,0 +1,146 @@
+"""Offline per-epoch band power extraction over whole recordings."""
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from optparse import OptionParser
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .features import BANDS, welch_plan
+
+
+def epoch_band_powers(data, sfreq=256., epoch_length=30., nperseg=512,
+                      bands=BANDS, batch_size=256):
+    """Welch band power of every epoch and channel of a recording.
+
+    Epochs and Welch segments (50% overlap) are strided views of the data,
+    so no copy of the signal is made before windowing. Segments of
+    `batch_size` epochs are transformed with a single `rfft` call.
+
+    Args:
+        data (array_like): signal of shape (n_channels, n_samples)
+
+    Keyword Args:
+        sfreq (float): sampling frequency
+        epoch_length (float): length of an epoch in seconds
+        nperseg (int): number of samples of each Welch segment
+        bands (OrderedDict): name -> (fmin, fmax) of the bands to compute
+        batch_size (int): number of epochs transformed at once, bounds the
+            memory used
+
+    Returns:
+        (numpy.ndarray): float32 band powers of shape
+            (n_epochs, n_channels, n_bands). The incomplete last epoch is
+            dropped.
+    """
+    data = np.asarray(data)
+    n_channels = data.shape[0]
+    n_epoch = int(round(epoch_length * sfreq))
+    if n_epoch < nperseg:
+        raise(ValueError('epoch_length must be longer than one segment'))
+    n_epochs = data.shape[1] // n_epoch
+    step = nperseg // 2
+
+    # (n_channels, n_epochs, n_epoch) view, then
+    # (n_channels, n_epochs, n_segments, nperseg) view
+    epochs = data[:, :n_epochs * n_epoch].reshape(n_channels, n_epochs,
+                                                  n_epoch)
+    segments = sliding_window_view(epochs, nperseg, axis=2)[:, :, ::step]
+
+    taper, _, scale, band_matrix = welch_plan(nperseg, sfreq, bands)
+
+    powers = np.empty((n_epochs, n_channels, len(bands)), dtype=np.float32)
+    for start in range(0, n_epochs, batch_size):
+        seg = segments[:, start:start + batch_size]
+        seg = (seg - seg.mean(axis=-1, keepdims=True)) * taper
+        spectrum = np.fft.rfft(seg, axis=-1)
+        psd = (spectrum.real ** 2 + spectrum.imag ** 2).mean(axis=2) * scale
+        powers[start:start + batch_size] = np.dot(psd, band_matrix) \
+            .transpose(1, 0, 2)
+    return powers
+
+
+def extract_file(filename, out_dir, sfreq=256., epoch_length=30.,
+                 nperseg=512, ch_ind=[0, 1, 2, 3], bands=BANDS):
+    """Compute the epoch band powers of a CSV recording and save them.
+
+    The features are saved as ``<out_dir>/<name>.npz`` holding
+    `band_powers` (n_epochs, n_channels, n_bands) in float32 along with
+    `ch_names`, `bands` and `epoch_length`.
+
+    Args:
+        filename (str): CSV recording with a timestamp column followed by
+            the channels
+        out_dir (str): directory where the features are written
+
+    Keyword Args:
+        sfreq (float): sampling frequency
+        epoch_length (float): length of an epoch in seconds
+        nperseg (int): number of samples of each Welch segment
+        ch_ind (list): indices of the EEG channels to keep
+        bands (OrderedDict): name -> (fmin, fmax) of the bands to compute
+
+    Returns:
+        (str): path of the written file
+    """
+    header = pd.read_csv(filename, index_col=0, nrows=0)
+    ch_names = [header.columns[i] for i in ch_ind]
+    data = pd.read_csv(filename, usecols=ch_names,
+                       dtype={c: np.float32 for c in ch_names})
+    data = np.nan_to_num(data[ch_names].values.T)
+
+    powers = epoch_band_powers(data, sfreq=sfreq, epoch_length=epoch_length,
+                               nperseg=nperseg, bands=bands)
+
+    name = os.path.splitext(os.path.basename(filename))[0]
+    out_file = os.path.join(out_dir, name + '.npz')
+    np.savez_compressed(out_file, band_powers=powers, ch_names=ch_names,
+                        bands=list(bands.keys()), epoch_length=epoch_length)
+    return out_file
+
+
+def extract_files(filenames, out_dir, n_jobs=None, **kwargs):
+    """Extract the features of many recordings in parallel.
+
+    Args:
+        filenames (list): CSV recordings
+        out_dir (str): directory where the features are written
+
+    Keyword Args:
+        n_jobs (int or None): number of worker processes, defaults to the
+            number of CPUs
+        **kwargs: forwarded to `extract_file`
+
+    Yields:
+        (str, str): recording and path of its features, as they complete
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {executor.submit(extract_file, fname, out_dir, **kwargs):
+                   fname for fname in filenames}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options] recording.csv ...")
+    parser.add_option("-o", "--out-dir",
+                      dest="out_dir", type='string', default='features',
+                      help="directory where the features are written.")
+    parser.add_option("-e", "--epoch-length",
+                      dest="epoch_length", type='float', default=30.,
+                      help="length of an epoch in seconds.")
+    parser.add_option("-s", "--sfreq",
+                      dest="sfreq", type='float', default=256.,
+                      help="sampling frequency of the recordings.")
+    parser.add_option("-j", "--jobs",
+                      dest="jobs", type='int', default=None,
+                      help="number of worker processes.")
+    (options, args) = parser.parse_args()
+
+    for fname, out_file in extract_files(args, options.out_dir,
+                                         n_jobs=options.jobs,
+                                         sfreq=options.sfreq,
+                                         epoch_length=options.epoch_length):
+        print('%s -> %s' % (fname, out_file))
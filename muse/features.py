@@ -0,0 +1,146 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+BANDS = OrderedDict([('delta', (1., 4.)),
+                     ('theta', (4., 8.)),
+                     ('alpha', (8., 13.)),
+                     ('beta', (13., 30.)),
+                     ('gamma', (30., 44.))])
+
+
+def welch_plan(nperseg, sfreq, bands=BANDS):
+    """Precompute what the Welch band powers of nperseg-sample segments need.
+
+    Args:
+        nperseg (int): number of samples of each Welch segment
+        sfreq (float): sampling frequency
+        bands (OrderedDict): name -> (fmin, fmax) of the bands to compute
+
+    Returns:
+        (tuple): `taper` the periodic Hann window, `freqs` the rfft
+            frequencies, `scale` the one-sided PSD scale of each frequency
+            (DC and Nyquist not doubled) and `band_matrix` of shape
+            (n_freqs, n_bands) summing a PSD into band powers
+    """
+    taper = 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(nperseg) / nperseg)
+    freqs = np.fft.rfftfreq(nperseg, 1. / sfreq)
+    scale = np.full(len(freqs), 2. / (sfreq * np.sum(taper ** 2)))
+    scale[0] /= 2.
+    if nperseg % 2 == 0:
+        scale[-1] /= 2.
+    band_matrix = np.array([(freqs >= fmin) & (freqs < fmax)
+                            for fmin, fmax in bands.values()],
+                           dtype=float).T * (freqs[1] - freqs[0])
+    return taper, freqs, scale, band_matrix
+
+
+class BandPowerEngine():
+    """Sliding-window band power of a live EEG stream.
+
+    Samples are kept per channel in a ring buffer of one Welch segment. Every
+    `step` samples a single new segment is windowed and transformed (all
+    channels at once) and its periodogram replaces the oldest one of the
+    window, so the Welch estimate over the whole window is updated with one
+    FFT per hop instead of being recomputed from scratch.
+    """
+
+    def __init__(self, callback=None, n_channels=5, sfreq=256., window=4.,
+                 nperseg=256, rate=2., bands=BANDS):
+        """Initialize
+
+        Args:
+            callback (callable): called as callback(powers, timestamp) with
+                powers of shape (n_channels, n_bands) at every hop
+            n_channels (int): number of channels of the incoming stream
+            sfreq (float): sampling frequency of the incoming stream
+            window (float): length in seconds of the Welch window
+            nperseg (int): number of samples of each Welch segment
+            rate (float): output rate in Hz, sets the hop between segments
+            bands (OrderedDict): name -> (fmin, fmax) of the bands to compute
+        """
+        self.callback = callback
+        self.n_channels = n_channels
+        self.sfreq = sfreq
+        self.nperseg = nperseg
+        self.bands = OrderedDict(bands)
+
+        self.step = int(round(sfreq / rate))
+        if not 0 < self.step <= nperseg:
+            raise(ValueError('rate must be between sfreq / nperseg and sfreq'))
+        n_window = int(round(window * sfreq))
+        if n_window < nperseg:
+            raise(ValueError('window must be longer than one segment'))
+        self.n_segments = (n_window - nperseg) // self.step + 1
+        self.rate = sfreq / self.step
+
+        # window planning, done once
+        self._taper, self.freqs, self._scale, self._band_matrix = \
+            welch_plan(nperseg, sfreq, self.bands)
+
+        self.reset()
+
+    @property
+    def band_names(self):
+        return list(self.bands.keys())
+
+    def reset(self):
+        """Forget every sample received so far."""
+        self._buffer = np.zeros((self.n_channels, self.nperseg))
+        self._pos = 0
+        self._n_received = 0
+        self._since_hop = 0
+        self._psd_ring = np.zeros((self.n_segments, self.n_channels,
+                                   len(self.freqs)))
+        self._psd_sum = np.zeros((self.n_channels, len(self.freqs)))
+        self._ring_index = 0
+        self._n_psd = 0
+
+    def push(self, data, timestamps):
+        """Feed a chunk of samples of shape (n_channels, n_samples).
+
+        Has the same signature as the Muse callback so it can be used
+        directly as one.
+        """
+        data = np.asarray(data)
+        n_samples = data.shape[1]
+        start = 0
+        while start < n_samples:
+            n = min(n_samples - start, self.step - self._since_hop,
+                    self.nperseg - self._pos)
+            self._buffer[:, self._pos:self._pos + n] = data[:, start:start + n]
+            self._pos = (self._pos + n) % self.nperseg
+            self._n_received += n
+            self._since_hop += n
+            start += n
+            if self._since_hop == self.step:
+                self._since_hop = 0
+                if self._n_received >= self.nperseg:
+                    powers = self._update()
+                    if self.callback is not None:
+                        self.callback(powers, timestamps[start - 1])
+
+    def band_powers(self):
+        """Band power (n_channels, n_bands) of the current window."""
+        if self._n_psd == 0:
+            return np.zeros((self.n_channels, len(self.bands)))
+        return np.dot(self._psd_sum / self._n_psd, self._band_matrix)
+
+    def _update(self):
+        """Add the periodogram of the latest segment to the window."""
+        segment = np.concatenate((self._buffer[:, self._pos:],
+                                  self._buffer[:, :self._pos]), axis=1)
+        segment = segment - segment.mean(axis=1, keepdims=True)
+        spectrum = np.fft.rfft(segment * self._taper, axis=1)
+        psd = (spectrum.real ** 2 + spectrum.imag ** 2) * self._scale
+
+        self._psd_sum -= self._psd_ring[self._ring_index]
+        self._psd_ring[self._ring_index] = psd
+        self._psd_sum += psd
+        self._ring_index = (self._ring_index + 1) % self.n_segments
+        if self._ring_index == 0:
+            # resync the running sum to avoid accumulating rounding errors
+            self._psd_sum = self._psd_ring.sum(axis=0)
+        self._n_psd = min(self._n_psd + 1, self.n_segments)
+        return self.band_powers()
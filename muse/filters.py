@@ -0,0 +1,94 @@
+import numpy as np
+from scipy.signal import butter, iirnotch, sosfilt, sosfilt_zi, tf2sos
+
+
+def make_sos(sfreq=256., notch=None, bandpass=None, order=4, notch_q=30.):
+    """Design the second-order sections of a notch and/or band-pass filter.
+
+    Keyword Args:
+        sfreq (float): sampling frequency
+        notch (float or None): frequency of the notch, e.g. 60.
+        bandpass (tuple or None): (low, high) corner frequencies. Either can
+            be None for a high-pass or low-pass filter.
+        order (int): order of the butterworth band-pass
+        notch_q (float): quality factor of the notch
+
+    Returns:
+        (numpy.ndarray): second-order sections, shape (n_sections, 6)
+    """
+    sections = []
+    if notch is not None:
+        sections.append(tf2sos(*iirnotch(notch, notch_q, fs=sfreq)))
+    if bandpass is not None:
+        low, high = bandpass
+        if low is not None and high is not None:
+            sections.append(butter(order, [low, high], btype='bandpass',
+                                   fs=sfreq, output='sos'))
+        elif low is not None:
+            sections.append(butter(order, low, btype='highpass', fs=sfreq,
+                                   output='sos'))
+        elif high is not None:
+            sections.append(butter(order, high, btype='lowpass', fs=sfreq,
+                                   output='sos'))
+    if not sections:
+        raise(ValueError('At least one of notch or bandpass must be set'))
+    return np.vstack(sections)
+
+
+class StreamingFilter():
+    """Causal IIR filter applied chunk by chunk on a live EEG stream.
+
+    The filter state is carried from one chunk to the next, so filtering a
+    stream in chunks gives the same result as filtering the whole recording
+    at once. All channels are filtered in a single call.
+    """
+
+    def __init__(self, callback=None, n_channels=5, sfreq=256., notch=None,
+                 bandpass=None, order=4, sos=None):
+        """Initialize
+
+        Args:
+            callback (callable): called as callback(data, timestamps) with the
+                filtered chunk, like the Muse callback
+            n_channels (int): number of channels of the incoming stream
+            sfreq (float): sampling frequency of the incoming stream
+            notch (float or None): frequency of the notch, e.g. 60.
+            bandpass (tuple or None): (low, high) corner frequencies
+            order (int): order of the butterworth band-pass
+            sos (numpy.ndarray or None): precomputed second-order sections,
+                overrides notch, bandpass and order
+        """
+        self.callback = callback
+        self.n_channels = n_channels
+        self.sfreq = sfreq
+        if sos is None:
+            sos = make_sos(sfreq, notch=notch, bandpass=bandpass, order=order)
+        self.sos = sos
+        self._zi_unit = sosfilt_zi(sos)
+        self.reset()
+
+    def reset(self):
+        """Reset the filter state, the next chunk restarts from steady state."""
+        self._zi = None
+
+    def filter(self, data):
+        """Filter a chunk of shape (n_channels, n_samples)."""
+        data = np.asarray(data, dtype=float)
+        if self._zi is None:
+            # start from the steady state of the first sample to avoid the
+            # transient caused by large DC offsets
+            self._zi = (self._zi_unit[:, None, :] *
+                        data[None, :, :1])
+        filtered, self._zi = sosfilt(self.sos, data, axis=1, zi=self._zi)
+        return filtered
+
+    def push(self, data, timestamps):
+        """Filter a chunk and forward it to the callback.
+
+        Has the same signature as the Muse callback so it can be used
+        directly as one.
+        """
+        filtered = self.filter(data)
+        if self.callback is not None:
+            self.callback(filtered, timestamps)
+        return filtered
@@ -0,0 +1,248 @@
+"""Multi-resolution min/max/mean pyramid of an EEG recording.
+
+The pyramid is stored in a directory next to the recording
+(``<recording>.pyramid``) with a ``meta.json`` description and one
+append-only ``level<k>.bin`` file per zoom level. Each block of a level is
+stored as float32 (min, max, mean) for every channel. Level 0 blocks span
+``base_block`` samples, and each level is ``factor`` times coarser than the
+previous one, so an overview of a whole night only reads a few kilobytes.
+"""
+import json
+import os
+from optparse import OptionParser
+
+import numpy as np
+import pandas as pd
+
+
+PYRAMID_SUFFIX = '.pyramid'
+META_FILE = 'meta.json'
+
+
+def pyramid_path(recording):
+    """Path of the pyramid directory of a recording."""
+    return recording + PYRAMID_SUFFIX
+
+
+class PyramidWriter():
+    """Build a pyramid incrementally while samples are being recorded."""
+
+    def __init__(self, path, n_channels, sfreq=256., ch_names=None,
+                 base_block=16, factor=4, n_levels=8):
+        """Initialize
+
+        Args:
+            path (str): pyramid directory, see `pyramid_path`
+            n_channels (int): number of channels of the recording
+            sfreq (float): sampling frequency of the recording
+            ch_names (list or None): names of the channels
+            base_block (int): number of samples of a level 0 block
+            factor (int): number of blocks of a level merged in the next one
+            n_levels (int): number of levels of the pyramid
+        """
+        self.path = path
+        self.n_channels = n_channels
+        self.meta = {'sfreq': sfreq,
+                     'n_channels': n_channels,
+                     'ch_names': ch_names or ['ch%d' % i
+                                              for i in range(n_channels)],
+                     'base_block': base_block,
+                     'factor': factor,
+                     'n_levels': n_levels,
+                     't0': None}
+        os.makedirs(path, exist_ok=True)
+        self._files = [open(os.path.join(path, 'level%d.bin' % k), 'wb')
+                       for k in range(n_levels)]
+        # pending (min, max, sum, count) of the unfinished block per level
+        self._pending = [self._empty() for k in range(n_levels)]
+        self._n_children = [0] * n_levels
+        self._write_meta()
+
+    def push(self, data, timestamps=None):
+        """Add a chunk of samples of shape (n_channels, n_samples).
+
+        Has the same signature as the Muse callback so it can be used
+        directly as one.
+        """
+        data = np.asarray(data, dtype=float)
+        if self.meta['t0'] is None and timestamps is not None and \
+                len(timestamps):
+            self.meta['t0'] = float(timestamps[0])
+            self._write_meta()
+
+        block = self.meta['base_block']
+        start = 0
+        n_samples = data.shape[1]
+        while start < n_samples:
+            n = min(n_samples - start, block - int(self._pending[0][3]))
+            chunk = data[:, start:start + n]
+            self._merge(0, (chunk.min(axis=1), chunk.max(axis=1),
+                            chunk.sum(axis=1), n))
+            start += n
+            if self._pending[0][3] == block:
+                self._close_block(0)
+
+    def close(self):
+        """Write the unfinished blocks and close the level files."""
+        for k in range(self.meta['n_levels']):
+            if self._pending[k][3] > 0:
+                self._close_block(k, final=True)
+        for f in self._files:
+            f.close()
+        self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _empty(self):
+        return (np.full(self.n_channels, np.inf),
+                np.full(self.n_channels, -np.inf),
+                np.zeros(self.n_channels), 0)
+
+    def _merge(self, level, stats):
+        mn, mx, total, count = self._pending[level]
+        self._pending[level] = (np.minimum(mn, stats[0]),
+                                np.maximum(mx, stats[1]),
+                                total + stats[2], count + stats[3])
+
+    def _close_block(self, level, final=False):
+        """Write the pending block of a level and merge it in the next."""
+        stats = self._pending[level]
+        mn, mx, total, count = stats
+        record = np.vstack((mn, mx, total / count)).astype(np.float32)
+        self._files[level].write(record.tobytes())
+        self._files[level].flush()
+        self._pending[level] = self._empty()
+
+        if level + 1 < self.meta['n_levels']:
+            self._merge(level + 1, stats)
+            self._n_children[level + 1] += 1
+            if not final and \
+                    self._n_children[level + 1] == self.meta['factor']:
+                self._n_children[level + 1] = 0
+                self._close_block(level + 1)
+
+    def _write_meta(self):
+        with open(os.path.join(self.path, META_FILE), 'w') as f:
+            json.dump(self.meta, f)
+
+
+class Pyramid():
+    """Read access to a pyramid built by `PyramidWriter`."""
+
+    def __init__(self, path):
+        """Initialize
+
+        Args:
+            path (str): pyramid directory, see `pyramid_path`
+        """
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.sfreq = self.meta['sfreq']
+        self.n_channels = self.meta['n_channels']
+        self.ch_names = self.meta['ch_names']
+
+    def block_size(self, level):
+        """Number of samples of a block of a level."""
+        return self.meta['base_block'] * self.meta['factor'] ** level
+
+    def n_blocks(self, level):
+        """Number of blocks written so far in a level."""
+        size = os.path.getsize(os.path.join(self.path, 'level%d.bin' % level))
+        return size // (3 * self.n_channels * 4)
+
+    def read_level(self, level, start=0, stop=None):
+        """Read blocks [start, stop) of a level.
+
+        Returns:
+            (numpy.ndarray): float32 array of shape (n_blocks, 3, n_channels)
+                holding min, max and mean of each block
+        """
+        n = self.n_blocks(level)
+        stop = n if stop is None else min(stop, n)
+        start = max(0, min(start, stop))
+        if stop == start:
+            return np.zeros((0, 3, self.n_channels), dtype=np.float32)
+        blocks = np.memmap(os.path.join(self.path, 'level%d.bin' % level),
+                           dtype=np.float32, mode='r',
+                           shape=(n, 3, self.n_channels))
+        return np.array(blocks[start:stop])
+
+    def choose_level(self, tmin, tmax, width):
+        """Coarsest level with at least `width` blocks in [tmin, tmax]."""
+        n_samples = max(tmax - tmin, 0.) * self.sfreq
+        for level in reversed(range(self.meta['n_levels'])):
+            if n_samples / self.block_size(level) >= width:
+                return level
+        return 0
+
+    def query(self, tmin, tmax, width):
+        """Get the summary of a time range for a display `width` pixels wide.
+
+        Args:
+            tmin (float): start of the range, in seconds from the start of
+                the recording
+            tmax (float): end of the range, in seconds
+            width (int): number of pixels of the display
+
+        Returns:
+            (dict): 'level', 'times' of the start of each block (seconds from
+                the start of the recording) and 'min', 'max' and 'mean' of
+                shape (n_channels, n_blocks)
+        """
+        level = self.choose_level(tmin, tmax, width)
+        block_duration = self.block_size(level) / self.sfreq
+        start = int(np.floor(max(tmin, 0.) / block_duration))
+        stop = int(np.ceil(tmax / block_duration))
+        blocks = self.read_level(level, start, stop)
+        times = (start + np.arange(len(blocks))) * block_duration
+        return {'level': level,
+                'times': times,
+                'min': blocks[:, 0].T,
+                'max': blocks[:, 1].T,
+                'mean': blocks[:, 2].T}
+
+
+def build_pyramid(filename, sfreq=256., chunksize=256 * 60, **kwargs):
+    """Build the pyramid of an existing CSV recording.
+
+    The file is read in chunks, so it never has to fit in memory.
+
+    Args:
+        filename (str): CSV recording with a timestamp column followed by
+            the channels
+
+    Keyword Args:
+        sfreq (float): sampling frequency of the recording
+        chunksize (int): number of rows read at once
+        **kwargs: forwarded to `PyramidWriter`
+
+    Returns:
+        (str): path of the pyramid
+    """
+    path = pyramid_path(filename)
+    writer = None
+    for chunk in pd.read_csv(filename, index_col=0, chunksize=chunksize):
+        if writer is None:
+            writer = PyramidWriter(path, chunk.shape[1], sfreq=sfreq,
+                                   ch_names=list(chunk.columns), **kwargs)
+            writer.meta['t0'] = pd.Timestamp(chunk.index[0]).timestamp()
+        writer.push(chunk.values.T)
+    if writer is not None:
+        writer.close()
+    return path
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="usage: %prog [options] recording.csv ...")
+    parser.add_option("-s", "--sfreq",
+                      dest="sfreq", type='float', default=256.,
+                      help="sampling frequency of the recordings.")
+    (options, args) = parser.parse_args()
+
+    for fname in args:
+        print('Built %s' % build_pyramid(fname, sfreq=options.sfreq))
@@ -0,0 +1,156 @@
+import numpy as np
+
+
+FLAT = 1
+RAILED = 2
+LINE_NOISE = 4
+NOISY = 8
+
+
+class SignalQualityMonitor():
+    """Rolling per-channel signal quality of a live EEG stream.
+
+    Samples are reduced into blocks of `step` samples (sum, sum of squares,
+    number of railed samples and demodulation at the line frequency). The
+    statistics of the window are running totals over a ring of blocks, so
+    each incoming sample is touched once whatever the window length.
+    """
+
+    def __init__(self, callback=None, on_change=None, n_channels=5,
+                 sfreq=256., window=2., rate=4., line_freq=60.,
+                 rail=999., flat_std=0.5, noisy_std=100., max_rail=0.05,
+                 max_line_ratio=0.5):
+        """Initialize
+
+        Args:
+            callback (callable): called as callback(scores, flags, timestamp)
+                at every hop, scores in [0, 1] and flags as a bitmask of
+                FLAT, RAILED, LINE_NOISE and NOISY, both of shape (n_channels,)
+            on_change (callable): called as on_change(channel, flags,
+                timestamp) when the flags of a channel change
+            n_channels (int): number of channels of the incoming stream
+            sfreq (float): sampling frequency of the incoming stream
+            window (float): length in seconds of the rolling window
+            rate (float): output rate in Hz
+            line_freq (float): frequency of the power line
+            rail (float): absolute value in uV above which a sample is railed
+            flat_std (float): standard deviation in uV under which a channel
+                is flat
+            noisy_std (float): standard deviation in uV above which a channel
+                is noisy
+            max_rail (float): fraction of railed samples above which a
+                channel is railed
+            max_line_ratio (float): fraction of the variance at the line
+                frequency above which a channel has line noise
+        """
+        self.callback = callback
+        self.on_change = on_change
+        self.n_channels = n_channels
+        self.sfreq = sfreq
+        self.line_freq = line_freq
+        self.rail = rail
+        self.flat_std = flat_std
+        self.noisy_std = noisy_std
+        self.max_rail = max_rail
+        self.max_line_ratio = max_line_ratio
+
+        self.step = int(round(sfreq / rate))
+        self.n_blocks = max(1, int(round(window * sfreq / self.step)))
+        self.rate = sfreq / self.step
+        self.reset()
+
+    def reset(self):
+        """Forget every sample received so far."""
+        shape = (self.n_blocks, self.n_channels)
+        self._s1 = np.zeros(shape)
+        self._s2 = np.zeros(shape)
+        self._railed = np.zeros(shape)
+        self._line = np.zeros(shape, dtype=complex)
+        self._count = np.zeros(self.n_blocks)
+        self._block = 0
+        self._since_hop = 0
+        self._sample_index = 0
+        self.flags = np.zeros(self.n_channels, dtype=int)
+        self.scores = np.ones(self.n_channels)
+
+    def push(self, data, timestamps):
+        """Feed a chunk of samples of shape (n_channels, n_samples).
+
+        Has the same signature as the Muse callback so it can be used
+        directly as one.
+        """
+        data = np.asarray(data, dtype=float)
+        n_samples = data.shape[1]
+        start = 0
+        while start < n_samples:
+            n = min(n_samples - start, self.step - self._since_hop)
+            self._accumulate(data[:, start:start + n])
+            self._since_hop += n
+            start += n
+            if self._since_hop == self.step:
+                self._since_hop = 0
+                self._update(timestamps[start - 1])
+
+    def stats(self):
+        """Rolling statistics of the current window.
+
+        Returns:
+            (dict): 'std', 'rail_fraction' and 'line_ratio', each of shape
+                (n_channels,)
+        """
+        n = max(self._count.sum(), 1.)
+        mean = self._s1.sum(axis=0) / n
+        var = np.maximum(self._s2.sum(axis=0) / n - mean ** 2, 0.)
+        # power of the line frequency component over the window
+        line_power = 2. * np.abs(self._line.sum(axis=0)) ** 2 / n ** 2
+        line_ratio = np.where(var > 0, line_power / np.maximum(var, 1e-12),
+                              0.)
+        return {'std': np.sqrt(var),
+                'rail_fraction': self._railed.sum(axis=0) / n,
+                'line_ratio': np.minimum(line_ratio, 1.)}
+
+    def _accumulate(self, chunk):
+        """Add a chunk that lies within the current block."""
+        n = chunk.shape[1]
+        phase = np.exp(-2j * np.pi * self.line_freq / self.sfreq *
+                       (self._sample_index + np.arange(n)))
+        self._sample_index += n
+        b = self._block
+        self._s1[b] += chunk.sum(axis=1)
+        self._s2[b] += np.einsum('ij,ij->i', chunk, chunk)
+        self._railed[b] += np.count_nonzero(np.abs(chunk) >= self.rail,
+                                            axis=1)
+        self._line[b] += np.dot(chunk, phase)
+        self._count[b] += n
+
+    def _update(self, timestamp):
+        """Score the window and move on to the next block."""
+        stats = self.stats()
+        flags = np.zeros(self.n_channels, dtype=int)
+        flags[stats['std'] < self.flat_std] |= FLAT
+        flags[stats['rail_fraction'] > self.max_rail] |= RAILED
+        flags[stats['line_ratio'] > self.max_line_ratio] |= LINE_NOISE
+        flags[stats['std'] > self.noisy_std] |= NOISY
+
+        badness = np.max([stats['rail_fraction'] / self.max_rail,
+                          stats['line_ratio'] / self.max_line_ratio,
+                          stats['std'] / self.noisy_std], axis=0)
+        scores = np.clip(1. - badness, 0., 1.)
+        scores[(flags & FLAT) > 0] = 0.
+
+        if self.on_change is not None:
+            for ch in np.flatnonzero(flags != self.flags):
+                self.on_change(int(ch), int(flags[ch]), timestamp)
+        self.flags = flags
+        self.scores = scores
+        if self.callback is not None:
+            self.callback(scores, flags, timestamp)
+
+        # recycle the oldest block
+        self._block = (self._block + 1) % self.n_blocks
+        b = self._block
+        self._s1[b] = 0.
+        self._s2[b] = 0.
+        self._railed[b] = 0.
+        self._line[b] = 0.
+        self._count[b] = 0
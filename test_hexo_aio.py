@@ -0,0 +1,156 @@
+#!/usr/bin/python
+"""Checks of the asyncio Hexoskin client against a local aiohttp server standing in for the api."""
+import asyncio
+
+from aiohttp import web
+
+from hexoskin.aio import AsyncApiHelper, AsyncApiResourceInstance
+
+N_RANGES = 45
+RESOURCES = ('range', 'user', 'record', 'data')
+SCHEMAS = {
+    'range': {'fields': {'id': {}, 'name': {}, 'resource_uri': {}, 'user': {'related_type': 'to_one'}},
+              'allowed_list_http_methods': ['get'], 'allowed_detail_http_methods': ['get', 'put', 'delete']},
+    'user': {'fields': {'id': {}, 'username': {}, 'resource_uri': {}},
+             'allowed_list_http_methods': ['get'], 'allowed_detail_http_methods': ['get']},
+    'record': {'fields': {'id': {}, 'start': {}, 'resource_uri': {}, 'user': {'related_type': 'to_one'}},
+               'allowed_list_http_methods': ['get'], 'allowed_detail_http_methods': ['get']},
+    'data': {'fields': {}, 'allowed_list_http_methods': ['get'], 'allowed_detail_http_methods': []},
+}
+
+
+def make_range(i):
+    return {'id': i, 'name': 'range %d' % i, 'resource_uri': '/api/range/%d/' % i, 'user': '/api/user/1/'}
+
+
+def create_app():
+    app = web.Application()
+    app['deleted'] = []
+
+    async def resource_list(request):
+        return web.json_response({name: {'list_endpoint': '/api/%s/' % name, 'schema': '/api/%s/schema/' % name}
+                                  for name in RESOURCES})
+
+    async def schema(request):
+        return web.json_response(SCHEMAS[request.match_info['name']])
+
+    async def range_list(request):
+        limit, offset = int(request.query.get('limit', 20)), int(request.query.get('offset', 0))
+        end = min(N_RANGES, offset + limit)
+        next_url = '/api/range/?limit=%d&offset=%d' % (limit, end) if end < N_RANGES else None
+        return web.json_response({
+            'meta': {'limit': limit, 'offset': offset, 'total_count': N_RANGES, 'next': next_url, 'previous': None},
+            'objects': [make_range(i) for i in range(offset, end)],
+        })
+
+    async def range_detail(request):
+        i = int(request.match_info['id'])
+        if request.method == 'DELETE':
+            app['deleted'].append(request.path)
+            return web.Response(status=204, content_type='application/json')
+        if request.method == 'PUT':
+            return web.json_response(dict(await request.json(), name='renamed %d' % i))
+        return web.json_response(make_range(i))
+
+    async def user_detail(request):
+        i = int(request.match_info['id'])
+        return web.json_response({'id': i, 'username': 'user%d' % i, 'resource_uri': request.path})
+
+    async def data_list(request):
+        return web.json_response([{
+            'user': '/api/user/1/',
+            'record': [{'id': 7, 'start': 1000, 'resource_uri': '/api/record/7/', 'user': '/api/user/1/'}],
+            'data': {'19': [[1000, 60], [1256, 61]]},
+        }])
+
+    app.router.add_get('/api/', resource_list)
+    app.router.add_get('/api/{name}/schema/', schema)
+    app.router.add_get('/api/range/', range_list)
+    app.router.add_route('*', '/api/range/{id:\\d+}/', range_detail)
+    app.router.add_get('/api/user/{id:\\d+}/', user_detail)
+    app.router.add_get('/api/data/', data_list)
+    return app
+
+
+async def run_with_api(check):
+    app = create_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    api = AsyncApiHelper(base_url='http://127.0.0.1:%d' % port)
+    # Keep the schemas of this throwaway server out of the stash files of the working directory
+    api._resource_cache = None
+    try:
+        async with api:
+            await check(api, app)
+    finally:
+        await runner.cleanup()
+
+
+def run(check):
+    asyncio.run(run_with_api(check))
+
+
+def test_list_and_get():
+    async def check(api, app):
+        ranges = await (await api.resource('range')).list()
+        assert len(ranges) == 20
+        assert ranges.nexturl
+        assert isinstance(ranges[0], AsyncApiResourceInstance)
+        assert ranges[3].name == 'range 3'
+        instance = await api.range.get(12)
+        assert instance.id == 12 and instance.resource_uri == '/api/range/12/'
+    run(check)
+
+
+def test_iter_all():
+    async def check(api, app):
+        ranges = await (await api.resource('range')).list()
+        ids = [r.id async for r in ranges.iter_all()]
+        assert ids == list(range(N_RANGES))
+    run(check)
+
+
+def test_data_list():
+    async def check(api, app):
+        rows = await (await api.resource('data')).list(datatype=19)
+        assert len(rows) == 1
+        assert rows[0].data == {19: [[1000, 60], [1256, 61]]}
+        assert rows[0].record[0].start == 1000
+        assert rows[0].record[0].resource_uri == '/api/record/7/'
+    run(check)
+
+
+def test_lazy_instances():
+    async def check(api, app):
+        await api.resource('user')
+        instance = await (await api.resource('range')).get(3)
+        user = instance.user
+        try:
+            user.username
+        except AttributeError as e:
+            assert 'await instance.load()' in str(e)
+        else:
+            raise AssertionError('A lazy instance must not be fetched on attribute access')
+        assert (await user.load()).username == 'user1'
+    run(check)
+
+
+def test_update_and_delete():
+    async def check(api, app):
+        instance = await (await api.resource('range')).get(5)
+        await instance.update()
+        assert instance.name == 'renamed 5'
+        await instance.delete()
+        assert app['deleted'] == ['/api/range/5/']
+        assert instance.id is None
+    run(check)
+
+
+if __name__ == '__main__':
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print('%s ok' % name)